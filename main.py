@@ -6,6 +6,8 @@ import numpy as np
 import utils.util
 import imageio
 import utils.util_gau
+import utils.util_avatar
+import utils.avatar_cache
 import tkinter as tk
 from tkinter import filedialog
 import os
@@ -13,8 +15,10 @@ import sys
 import argparse
 import time
 import copy
+import concurrent.futures
 from utils.frenet_arcle import *
-from renderers.renderer_ogl import OpenGLRenderer, GaussianRenderBase, OpenGLRendererAxes
+from renderers.renderer_ogl import OpenGLRenderer, GaussianRenderBase, OpenGLRendererAxes, get_sort_stats, set_strand_layout, set_avatar_layout, set_parallel_sort, \
+    get_sort_backends
 from plyfile import PlyData, PlyElement
 
 import torch
@@ -39,6 +43,21 @@ g_renderer_idx = BACKEND_OGL
 g_renderer: GaussianRenderBase = g_renderer_list[g_renderer_idx]
 g_scale_modifier = 1.
 g_auto_sort = True
+g_sort_backend_tables = ["auto"] + get_sort_backends()
+g_sort_backend = 0
+g_sort_auto_backend = "full"
+g_sort_timings = {}
+# (future, scene size) of the running calibration of the auto sort backend, and the scene size it last ran on
+g_sort_calibration = None
+g_sort_calibrated_n = 0
+g_sort_scheduler = utils.util.SortScheduler()
+# half float / 8 bit GPU layout of the scene, and the PSNR of its last comparison against full precision
+g_compact_layout = False
+g_compact_psnr = None
+# Memory the last closed avatar gave back
+g_close_report = None
+# Decoded PLY files of avatars and their strand points, set up from the command line
+g_avatar_cache = utils.avatar_cache.AvatarCache()
 g_show_control_win = False
 g_show_help_win = False
 g_show_camera_win = False
@@ -54,6 +73,10 @@ g_file_path = "Default Naive 4 Gaussian"
 CLICK_THRESHOLD = 0.2
 DISPLACEMENT_FACTOR = 1.5
 AVATAR_SEPARATION = 0.1
+# Threads the batch open loads avatars with, numpy and torch release the GIL for most of the loading
+LOAD_THREADS = min(8, os.cpu_count() or 1)
+# Closing an avatar compacts the scene arena once this fraction of its rows is in no slab
+ARENA_COMPACT_FRACTION = 0.5
 
 g_selection_distance = 0.02
 g_max_cutting_distance = 0.2
@@ -70,52 +93,56 @@ left_click_start_time = None
 # Head Avatars Variables
 ########################
 gaussians = utils.util_gau.naive_gaussian()
-flame_vertices = None
+# Scene arena the loaded avatars and their FLAME vertices have slabs in. Once an avatar
+# is opened, gaussians are all the rows of the arena
+g_arena = None
 g_show_head_avatars_win = True
-g_checkboxes = []
-g_head_avatars = []
-g_folder_paths = []
-g_frame_file = []
-g_frames = []
-g_hairstyle_file = []
-g_curls_file = []
-g_file_paths = []
-g_n_gaussians = []
-g_n_strands = []
-g_n_gaussians_per_strand = []
-g_n_hair_gaussians = []
-g_max_distance = []
-g_means = []
-g_hair_points = []
-g_hair_curls = []
-g_hair_amps_freqs = []
-g_hair_normals = []
+# Loaded avatars, and list-like views of their fields
+g_avatars = utils.util_avatar.AvatarRegistry()
+g_checkboxes = g_avatars.column("checkbox")
+g_head_avatars = g_avatars.column("head_avatar")
+g_folder_paths = g_avatars.column("folder_path")
+g_frame_file = g_avatars.column("frame_file")
+g_frames = g_avatars.column("frames")
+g_hairstyle_file = g_avatars.column("hairstyle_file")
+g_curls_file = g_avatars.column("curls_file")
+g_file_paths = g_avatars.column("file_path")
+g_n_gaussians = g_avatars.column("n_gaussians")
+g_n_strands = g_avatars.column("n_strands")
+g_n_gaussians_per_strand = g_avatars.column("n_gaussians_per_strand")
+g_n_hair_gaussians = g_avatars.column("n_hair_gaussians")
+g_max_distance = g_avatars.column("max_distance")
+g_means = g_avatars.column("means")
+g_hair_points = g_avatars.column("hair_points")
+g_hair_curls = g_avatars.column("hair_curls")
+g_hair_amps_freqs = g_avatars.column("hair_amps_freqs")
+g_hair_normals = g_avatars.column("hair_normals")
 g_z_max = 1
 g_z_min = -1
 g_cutting_mode = False
 g_coloring_mode = False
 g_keep_sh = True
 g_selected_color = [0.5, 0.5, 0.5]
-g_x_plane = []
-g_x_plane_max = []
-g_x_plane_min = []
-g_invert_x_plane = []
-g_y_plane = []
-g_y_plane_max = []
-g_y_plane_min = []
-g_invert_y_plane = []
-g_z_plane = []
-g_z_plane_max = []
-g_z_plane_min = []
-g_invert_z_plane = []
+g_x_plane = g_avatars.column("x_plane")
+g_x_plane_max = g_avatars.column("x_plane_max")
+g_x_plane_min = g_avatars.column("x_plane_min")
+g_invert_x_plane = g_avatars.column("invert_x_plane")
+g_y_plane = g_avatars.column("y_plane")
+g_y_plane_max = g_avatars.column("y_plane_max")
+g_y_plane_min = g_avatars.column("y_plane_min")
+g_invert_y_plane = g_avatars.column("invert_y_plane")
+g_z_plane = g_avatars.column("z_plane")
+g_z_plane_max = g_avatars.column("z_plane_max")
+g_z_plane_min = g_avatars.column("z_plane_min")
+g_invert_z_plane = g_avatars.column("invert_z_plane")
 g_hairstyles = ["Original File", "Selected File"]
-g_flame_model = []
-g_flame_param = []
-g_file_flame_param = []
-g_binding = []
-g_canonical_flame_hair = []
-g_n_flame_vertices = []
-g_show_flame_vertices = []
+g_flame_model = g_avatars.column("flame_model")
+g_flame_param = g_avatars.column("flame_param")
+g_file_flame_param = g_avatars.column("file_flame_param")
+g_binding = g_avatars.column("binding")
+g_canonical_flame_hair = g_avatars.column("canonical_flame_hair")
+g_n_flame_vertices = g_avatars.column("n_flame_vertices")
+g_show_flame_vertices = g_avatars.column("show_flame_vertices")
 
 g_strand_index = "None"
 g_gaussian_index = "None"
@@ -124,9 +151,28 @@ g_gaussian_strand_index = "None"
 ######################
 # Head Avatars Actions
 ######################
+def load_ply_cached(path):
+    # Rows, head avatar constants, and strand points and normals of a PLY file, memory
+    # mapped from the avatar cache unless the file changed since it was cached
+    cached = g_avatar_cache.get(path)
+    if cached is not None:
+        hair_points = (cached["hair_points"], cached["hair_normals"])
+        return utils.util_gau.PackedGaussianData.from_packed(cached["packed"]), tuple(cached["constants"]), hair_points
+
+    head_avatar, head_avatar_constants = utils.util_gau.load_ply(path)
+    n_strands, n_gaussians_per_strand = head_avatar_constants
+    hair_points = get_hair_points(head_avatar.xyz, head_avatar.rot, head_avatar.scale, n_strands, n_gaussians_per_strand, n_strands * n_gaussians_per_strand)
+    g_avatar_cache.put(path, {
+        "packed": head_avatar.packed,
+        "constants": np.array(head_avatar_constants),
+        "hair_points": hair_points[0],
+        "hair_normals": hair_points[1],
+    })
+    return head_avatar, head_avatar_constants, hair_points
+
 def load_avatar_from_folder(folder_path):
     # Load hair
-    hair, head_avatar_constants = utils.util_gau.load_ply(folder_path + "/hair.ply")
+    hair, head_avatar_constants, hair_points = load_ply_cached(folder_path + "/hair.ply")
 
     # Load head
     point_path = folder_path + "/head.ply"
@@ -144,111 +190,201 @@ def load_avatar_from_folder(folder_path):
     head_sh = head_sh.reshape(head_sh.shape[0], -1)
     head_avatar.sh = np.vstack([hair.sh, head_sh])
 
-    return head_avatar, head_avatar_constants, flame_model
+    return head_avatar, head_avatar_constants, flame_model, hair_points
     
 
-def open_head_avatar(path, head_avatar, head_avatar_constants, flame_model):
-    global gaussians, flame_vertices, g_z_min, g_z_max, g_folder_paths, g_file_paths, g_n_gaussians, g_n_strands, g_n_gaussians_per_strand, g_n_hair_gaussians, g_flame_model, g_flame_param, g_file_flame_param, g_binding, g_canonical_flame_hair
-
-    # Fill controller arrays
-    g_head_avatars.append(head_avatar)
-    g_means.append(np.mean(head_avatar.xyz, axis=0))
-    g_max_distance.append(np.max(np.linalg.norm(head_avatar.xyz - g_means[-1], axis=1)))
-    g_folder_paths.append(path.rsplit('/', 1)[0])
-    g_frame_file.append("")
-    g_frames.append(None)
-    g_hairstyle_file.append("")
-    g_curls_file.append("")
-    g_file_paths.append(path)
-    g_n_gaussians.append(head_avatar.xyz.shape[0])
-    g_n_strands.append(head_avatar_constants[0])
-    g_n_gaussians_per_strand.append(head_avatar_constants[1])
-    g_n_hair_gaussians.append(head_avatar_constants[0] * head_avatar_constants[1])
-    g_checkboxes.append(True)
-    hair_points, hair_normals = get_hair_points(head_avatar.xyz, head_avatar.rot, head_avatar.scale, g_n_strands[-1], g_n_gaussians_per_strand[-1], g_n_hair_gaussians[-1])
-    g_hair_points.append(hair_points)
-    g_hair_normals.append(hair_normals)
-    curls, amps_freqs = get_hair_rots_amps_freqs(-1)
-    g_hair_curls.append(curls)
-    g_hair_amps_freqs.append(amps_freqs)
-    g_show_hair.append(True)
-    g_show_head.append(True)
-    g_hair_color.append([1, 0, 0])
-    g_head_color.append([1, 1, 1])
-    g_show_hair_color.append(False)
-    g_show_head_color.append(False)
-    g_hair_scale.append(1)
-    g_wave_frequency.append(0)
-    g_wave_amplitude.append(0)
-    g_frame.append(0)
-    g_x_plane.append(np.max(head_avatar.xyz[:, 0]))
-    g_x_plane_max.append(np.max(head_avatar.xyz[:, 0]))
-    g_x_plane_min.append(np.min(head_avatar.xyz[:, 0]))
-    g_invert_x_plane.append(False)
-    g_y_plane.append(np.max(head_avatar.xyz[:, 1]))
-    g_y_plane_max.append(np.max(head_avatar.xyz[:, 1]))
-    g_y_plane_min.append(np.min(head_avatar.xyz[:, 1]))
-    g_invert_y_plane.append(False)
-    g_z_plane.append(np.max(head_avatar.xyz[:, 2]))
-    g_z_plane_max.append(np.max(head_avatar.xyz[:, 2]))
-    g_z_plane_min.append(np.min(head_avatar.xyz[:, 2]))
-    g_invert_z_plane.append(False)
-    g_selected_hairstyle.append(0)
-    g_hairstyles.append("Head Avatar " + str(len(g_selected_hairstyle)))
-
-    if len(g_head_avatars) == 1:
-        # Append head avatar to the gaussians object sent to the shader
-        xyz, rot, scale, opacity, sh = head_avatar.get_data()
-        gaussians.xyz = xyz
-        gaussians.rot = rot
-        gaussians.scale = scale
-        gaussians.opacity = np.ones_like(opacity)
-        gaussians.sh = sh
+def compute_flame_hair(flame_model, head_avatar, head_avatar_constants):
+    # Binding of the hair strands to the FLAME vertices, and the hair in canonical FLAME space
+    if not flame_model:
+        return None, None
+    n_strands, n_gaussians_per_strand = head_avatar_constants
+    hair_xyz = head_avatar.xyz[:n_strands * n_gaussians_per_strand, :]
+    binding = compute_binding(flame_model, hair_xyz, head_avatar_constants)
+    return binding, compute_canonical_flame_hair(flame_model, hair_xyz, binding)
+
+def load_head_avatar(path):
+    # Arguments of open_head_avatar for a PLY file or an avatar folder, computed off the UI thread
+    if os.path.isdir(path):
+        head_avatar, head_avatar_constants, flame_model, hair_points = load_avatar_from_folder(path)
     else:
-        # Append head avatar to the gaussians object sent to the shader
-        gaussians.xyz = np.vstack([gaussians.xyz, head_avatar.xyz]).astype(np.float32)
-        gaussians.rot = np.vstack([gaussians.rot, head_avatar.rot]).astype(np.float32)
-        gaussians.scale = np.vstack([gaussians.scale, head_avatar.scale]).astype(np.float32)
-        gaussians.opacity = np.vstack([gaussians.opacity, head_avatar.opacity]).astype(np.float32)
-        gaussians.sh = np.vstack([gaussians.sh, head_avatar.sh]).astype(np.float32)
-    
-    # FLAME Gaussian class object
-    g_flame_model.append(flame_model)
-    # FLAME class object 
-    g_flame_param.append(flame_model.flame_param if flame_model else None)
-    # FLAME parameters
-    g_file_flame_param.append(copy.deepcopy(g_flame_param[-1]))
-    # Binding
-    hair_xyz = head_avatar.xyz[:g_n_hair_gaussians[-1], :]
-    binding = compute_binding(flame_model, hair_xyz, head_avatar_constants) if flame_model else None
-    g_binding.append(binding)
-    # Canonical hair
-    canonical_flame_hair = compute_canonical_flame_hair(flame_model, hair_xyz, binding) if flame_model else None
-    g_canonical_flame_hair.append(canonical_flame_hair)
-    # Show FLAME Vertices
-    g_show_flame_vertices.append(False)
-    # Number of FLAME Vertices
+        (head_avatar, head_avatar_constants, hair_points), flame_model = load_ply_cached(path), None
+    flame_hair = compute_flame_hair(flame_model, head_avatar, head_avatar_constants)
+    return head_avatar, head_avatar_constants, flame_model, hair_points, flame_hair
+
+def open_head_avatars(paths):
+    # Loads the avatars concurrently, and opens them in the order of paths. Paths that fail to
+    # load or to open are skipped, the number of opened avatars is returned
+    n_opened = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LOAD_THREADS) as pool:
+        futures = [pool.submit(load_head_avatar, path) for path in paths]
+        for path, future in zip(paths, futures):
+            # any error of a loader thread is reported here instead of ending the main loop
+            try:
+                loaded = future.result()
+            except Exception as e:
+                print(f"Could not load {path}: {e!r}")
+                continue
+            try:
+                open_head_avatar(path, *loaded)
+            except Exception as e:
+                print(f"Could not open {path}: {e!r}")
+                continue
+            n_opened += 1
+    return n_opened
+
+def open_head_avatar(path, head_avatar, head_avatar_constants, flame_model, hair_points=None, flame_hair=None):
+    global gaussians, g_arena, g_z_min, g_z_max
+
+    # Everything that can fail is computed before the avatar is registered, so that a failed
+    # avatar leaves no record, hairstyle or arena rows behind
     n_flame_vertices = flame_model.verts.shape[1] if flame_model else 0
-    g_n_flame_vertices.append(n_flame_vertices)
-
+    n_strands, n_gaussians_per_strand = head_avatar_constants
+    n_hair_gaussians = n_strands * n_gaussians_per_strand
+    means = np.mean(head_avatar.xyz, axis=0)
+    if hair_points is None:
+        hair_points = get_hair_points(head_avatar.xyz, head_avatar.rot, head_avatar.scale, n_strands, n_gaussians_per_strand, n_hair_gaussians)
+    hair_points, hair_normals = hair_points
+    # Binding and canonical hair
+    if flame_hair is None:
+        flame_hair = compute_flame_hair(flame_model, head_avatar, head_avatar_constants)
+    binding, canonical_flame_hair = flame_hair
+    flame_param = flame_model.flame_param if flame_model else None
+    record = utils.util_avatar.AvatarRecord(
+        head_avatar=utils.util_avatar.AvatarState(head_avatar),
+        checkbox=True,
+        folder_path=path.rsplit('/', 1)[0],
+        file_path=path,
+        frame_file="",
+        frames=None,
+        hairstyle_file="",
+        curls_file="",
+        n_gaussians=head_avatar.xyz.shape[0],
+        n_strands=n_strands,
+        n_gaussians_per_strand=n_gaussians_per_strand,
+        n_hair_gaussians=n_hair_gaussians,
+        means=means,
+        max_distance=np.max(np.linalg.norm(head_avatar.xyz - means, axis=1)),
+        hair_points=hair_points,
+        hair_normals=hair_normals,
+        # no curls file is chosen yet
+        hair_curls=None,
+        hair_amps_freqs=None,
+        show_hair=True,
+        show_head=True,
+        hair_color=[1, 0, 0],
+        head_color=[1, 1, 1],
+        show_hair_color=False,
+        show_head_color=False,
+        hair_scale=1,
+        wave_frequency=0,
+        wave_amplitude=0,
+        frame=0,
+        selected_hairstyle=0,
+        x_plane=np.max(head_avatar.xyz[:, 0]),
+        x_plane_max=np.max(head_avatar.xyz[:, 0]),
+        x_plane_min=np.min(head_avatar.xyz[:, 0]),
+        invert_x_plane=False,
+        y_plane=np.max(head_avatar.xyz[:, 1]),
+        y_plane_max=np.max(head_avatar.xyz[:, 1]),
+        y_plane_min=np.min(head_avatar.xyz[:, 1]),
+        invert_y_plane=False,
+        z_plane=np.max(head_avatar.xyz[:, 2]),
+        z_plane_max=np.max(head_avatar.xyz[:, 2]),
+        z_plane_min=np.min(head_avatar.xyz[:, 2]),
+        invert_z_plane=False,
+        # FLAME Gaussian class object, its parameters and those it was loaded with
+        flame_model=flame_model,
+        flame_param=flame_param,
+        file_flame_param=copy.deepcopy(flame_param),
+        binding=binding,
+        canonical_flame_hair=canonical_flame_hair,
+        show_flame_vertices=False,
+        n_flame_vertices=n_flame_vertices,
+    )
     if flame_model:
         xyz = flame_model.verts[0].cpu().numpy().astype(np.float32)
-        rot = np.tile([1, 0, 0, 0], (g_n_flame_vertices[-1], 1)).astype(np.float32)
-        scale = np.full((g_n_flame_vertices[-1], 3), 0.001).astype(np.float32)
-        opacity = np.full((g_n_flame_vertices[-1], 1), 0).astype(np.float32)
-        sh = np.tile([1, 0, 0], (g_n_flame_vertices[-1], 1)).astype(np.float32)
+        rot = np.tile([1, 0, 0, 0], (n_flame_vertices, 1)).astype(np.float32)
+        scale = np.full((n_flame_vertices, 3), 0.001).astype(np.float32)
+        opacity = np.full((n_flame_vertices, 1), 0).astype(np.float32)
+        sh = np.tile([1, 0, 0], (n_flame_vertices, 1)).astype(np.float32)
         sh = (sh - 0.5) / 0.28209
+        flame_vertices = util_gau.GaussianData(xyz, rot, scale, opacity, sh)
 
-        if len(g_head_avatars) == 1:
-            flame_vertices = util_gau.GaussianData(xyz, rot, scale, opacity, sh)
-        else:
-            flame_vertices.xyz = np.vstack([flame_vertices.xyz, xyz]).astype(np.float32)
-            flame_vertices.rot = np.vstack([flame_vertices.rot, rot]).astype(np.float32)
-            flame_vertices.scale = np.vstack([flame_vertices.scale, scale]).astype(np.float32)
-            flame_vertices.opacity = np.vstack([flame_vertices.opacity, opacity]).astype(np.float32)
-            flame_vertices.sh = np.vstack([flame_vertices.sh, sh]).astype(np.float32)
-
+    # Slabs of the head avatar and of its FLAME vertices, the rows of the other avatars stay
+    # where they are. Slabs of an avatar that does not fit the arena are freed again
+    if g_arena is None:
+        g_arena = utils.util_gau.GaussianArena(head_avatar.sh_dim)
+    start = flame_start = None
+    try:
+        start = g_arena.alloc(head_avatar.xyz.shape[0])
+        g_arena.write(start, head_avatar)
+        if flame_model:
+            flame_start = g_arena.alloc(n_flame_vertices)
+            g_arena.write(flame_start, flame_vertices)
+    except Exception:
+        for slab in (start, flame_start):
+            if slab is not None:
+                g_arena.free(slab)
+        gaussians = g_arena.data
+        raise
+
+    # Register the avatar
+    record.start, record.flame_start = start, flame_start
+    g_avatars.add(record)
+    g_hairstyles.append("Head Avatar " + str(len(g_avatars)))
+
+    # The arena is reallocated when it runs out of rows, which the renderer uploads in full
+    gaussians = g_arena.data
     g_renderer.update_n_gaussians(g_n_gaussians[-1])
+    g_renderer.mark_dirty(start, start+g_n_gaussians[-1])
+    if flame_model:
+        g_renderer.mark_dirty(flame_start, flame_start+n_flame_vertices)
+    update_sort_layout()
+
+def close_head_avatar(i):
+    global gaussians, g_selected_head_avatar_index
+    record = g_avatars.remove(i)
+    cpu_bytes = utils.util_avatar.nbytes(record)
+    arena_bytes = g_arena.nbytes()
+    rows = record.n_gaussians + record.n_flame_vertices
+
+    # The rows of the avatar are cleared and reused by the next avatar or hairstyle that fits,
+    # the arena is only compacted once too many of them are unused
+    g_arena.free(record.start)
+    g_renderer.mark_dirty(record.start, record.start+record.n_gaussians)
+    if record.flame_model:
+        g_arena.free(record.flame_start)
+        g_renderer.mark_dirty(record.flame_start, record.flame_start+record.n_flame_vertices)
+    if g_arena.spare_rows() > ARENA_COMPACT_FRACTION * len(g_arena):
+        moved = g_arena.compact()
+        for other in g_avatars:
+            other.start = moved[other.start]
+            if other.flame_model:
+                other.flame_start = moved[other.flame_start]
+    gaussians = g_arena.data
+
+    # Hairstyles taken from avatars are listed by avatar number
+    k = g_hairstyles.index("Head Avatar " + str(i + 1))
+    del g_hairstyles[k]
+    g_hairstyles[k:] = ["Head Avatar " + str(int(name.split()[-1]) - 1) for name in g_hairstyles[k:]]
+    for j in range(len(g_avatars)):
+        if g_selected_hairstyle[j] == k:
+            g_selected_hairstyle[j] = 0
+        elif g_selected_hairstyle[j] > k:
+            g_selected_hairstyle[j] -= 1
+
+    if g_selected_head_avatar_index == i:
+        select_head_avatar(-1)
+    elif g_selected_head_avatar_index > i:
+        select_head_avatar(g_selected_head_avatar_index - 1)
+    update_displacements_and_opacities()
+    update_sort_layout()
+    # bytes of avatar state, freed scene rows and bytes of the scene arena given back
+    return cpu_bytes, rows, arena_bytes - g_arena.nbytes()
+
+def update_sort_layout():
+    set_strand_layout([(get_start_index(i), g_n_strands[i], g_n_gaussians_per_strand[i]) for i in range(len(g_head_avatars))])
+    set_avatar_layout([(get_start_index(i), g_n_gaussians[i]) for i in range(len(g_head_avatars))])
 
 def export_head_avatar(file_path):
     i = g_selected_head_avatar_index
@@ -349,25 +485,23 @@ def export_head_avatar(file_path):
 g_show_head_avatar_controller_win = True
 g_selected_head_avatar_index = -1
 g_selected_head_avatar_name = "None"
-g_show_hair = []
-g_show_head = []
-g_hair_color = []
-g_head_color = []
-g_show_hair_color = []
-g_show_head_color = []
-g_hair_scale = []
-g_wave_frequency = []
-g_wave_amplitude = []
-g_frame = []
-g_selected_hairstyle = []
+g_show_hair = g_avatars.column("show_hair")
+g_show_head = g_avatars.column("show_head")
+g_hair_color = g_avatars.column("hair_color")
+g_head_color = g_avatars.column("head_color")
+g_show_hair_color = g_avatars.column("show_hair_color")
+g_show_head_color = g_avatars.column("show_head_color")
+g_hair_scale = g_avatars.column("hair_scale")
+g_wave_frequency = g_avatars.column("wave_frequency")
+g_wave_amplitude = g_avatars.column("wave_amplitude")
+g_frame = g_avatars.column("frame")
+g_selected_hairstyle = g_avatars.column("selected_hairstyle")
 
 ################################
 # Head Avatar Controller Actions
 ################################
 def get_start_index(head_avatar_index):
-    if head_avatar_index == 0:
-        return 0
-    return np.cumsum(g_n_gaussians)[head_avatar_index - 1]
+    return g_avatars.start(head_avatar_index)
 
 def get_closest_head_avatar_index():
     if len(g_head_avatars) == 0 or np.sum(g_checkboxes) == 0:
@@ -503,8 +637,9 @@ def update_displacements_and_opacities():
     global gaussians
 
     for i in range(len(g_head_avatars)):
-        xyz, _, _, opacity, _ = g_head_avatars[i].get_data()
+        opacity = g_head_avatars[i].get_opacity()
         start = get_start_index(i)
+        g_renderer.mark_dirty(start, start+g_n_gaussians[i], "opacity")
 
         if g_checkboxes[i] and (g_show_hair[i] or g_show_head[i]):
             update_means(i)
@@ -515,48 +650,53 @@ def update_displacements_and_opacities():
 def update_head_opacity():
     i = g_selected_head_avatar_index
     start = get_start_index(i)
+    g_renderer.mark_dirty(start+g_n_hair_gaussians[i], start+g_n_gaussians[i], "opacity")
     if g_show_head[i]:
-        _, _, _, opacity, _ = g_head_avatars[i].get_data()
-        gaussians.opacity[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = opacity[g_n_hair_gaussians[i]:, :]
+        opacity = g_head_avatars[i].get_opacity(g_n_hair_gaussians[i])
+        gaussians.opacity[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = opacity
     else:
         gaussians.opacity[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = 0
 
 def update_hair_opacity():
     i = g_selected_head_avatar_index
     start = get_start_index(i)
+    g_renderer.mark_dirty(start, start+g_n_hair_gaussians[i], "opacity")
     if g_show_hair[i]:
-        _, _, _, opacity, _ = g_head_avatars[i].get_data()
-        gaussians.opacity[start:start+g_n_hair_gaussians[i], :] = opacity[:g_n_hair_gaussians[i], :]
+        opacity = g_head_avatars[i].get_opacity(0, g_n_hair_gaussians[i])
+        gaussians.opacity[start:start+g_n_hair_gaussians[i], :] = opacity
     else:
         gaussians.opacity[start:start+g_n_hair_gaussians[i], :] = 0
 
 def update_head_color():
     i = g_selected_head_avatar_index
     start = get_start_index(i)
+    g_renderer.mark_dirty(start+g_n_hair_gaussians[i], start+g_n_gaussians[i], "sh")
     if g_show_head_color[i]:
         head_color =  np.asarray(g_head_color[i])
         head_color = (head_color - 0.5) / 0.28209
         gaussians.sh[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], 0:3] = head_color.T
     else:
-        _, _, _, _, sh = g_head_avatars[i].get_data()
-        gaussians.sh[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = sh[g_n_hair_gaussians[i]:, :]
+        sh = g_head_avatars[i].get_sh(g_n_hair_gaussians[i])
+        gaussians.sh[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = sh
 
 def update_hair_color():
     i = g_selected_head_avatar_index
     start = get_start_index(i)
+    g_renderer.mark_dirty(start, start+g_n_hair_gaussians[i], "sh")
     if g_show_hair_color[i]:
         hair_color =  np.asarray(g_hair_color[i])
         hair_color = (hair_color - 0.5) / 0.28209
         gaussians.sh[start:start+g_n_hair_gaussians[i], 0:3] = hair_color.T
     else:
-        _, _, _, _, sh = g_head_avatars[i].get_data()
-        gaussians.sh[start:start+g_n_hair_gaussians[i], :] = sh[:g_n_hair_gaussians[i], :]
+        sh = g_head_avatars[i].get_sh(0, g_n_hair_gaussians[i])
+        gaussians.sh[start:start+g_n_hair_gaussians[i], :] = sh
 
 def update_hair_scale():
     i = g_selected_head_avatar_index
     start = get_start_index(i)
-    _, _, scale, _, _ = g_head_avatars[i].get_data()
-    gaussians.scale[start:start+g_n_hair_gaussians[i], :] = scale[:g_n_hair_gaussians[i]] * g_hair_scale[i]
+    scale = g_head_avatars[i].get_scale(0, g_n_hair_gaussians[i])
+    gaussians.scale[start:start+g_n_hair_gaussians[i], :] = scale * g_hair_scale[i]
+    g_renderer.mark_dirty(start, start+g_n_hair_gaussians[i], "scale")
 
 def update_frame():
     i = g_selected_head_avatar_index
@@ -565,13 +705,14 @@ def update_frame():
     if g_frame[i]:
         frame = min(g_frame[i], frames_array.shape[0]-1)
         frame_array = frames_array[frame]
-        g_head_avatars[i].xyz[:g_n_hair_gaussians[i]] = frame_array[:, :3]
-        g_head_avatars[i].rot[:g_n_hair_gaussians[i]] = frame_array[:, 3:7]
+        g_head_avatars[i].set("xyz", slice(0, g_n_hair_gaussians[i]), frame_array[:, :3])
+        g_head_avatars[i].set("rot", slice(0, g_n_hair_gaussians[i]), frame_array[:, 3:7])
         gaussians.rot[start:start+g_n_hair_gaussians[i], :] = frame_array[:, 3:7]
+        g_renderer.mark_dirty(start, start+g_n_hair_gaussians[i], "rot")
         xscale = frame_array[:, 7]
         scales = np.ones_like(xscale) * 0.0001
         scale = np.dstack([xscale, scales, scales])
-        g_head_avatars[i].scale[:g_n_hair_gaussians[i]] = scale
+        g_head_avatars[i].set("scale", slice(0, g_n_hair_gaussians[i]), scale[0])
         update_means(i)
 
 def get_hair_rots_amps_freqs(idx):
@@ -589,16 +730,18 @@ def update_means(head_avatar_index):
     start = get_start_index(i)
     d = get_displacement(i)
 
-    xyz, rot, scale, _, _ = g_head_avatars[i].get_data()
-    gaussians.xyz[start:start+g_n_gaussians[i], :] = xyz
+    # The edited avatar is written straight into its scene rows, without copies of its attributes
+    g_renderer.mark_dirty(start, start+g_n_gaussians[i], "xyz", "rot", "scale")
+    g_head_avatars[i].get_into("xyz", gaussians.xyz[start:start+g_n_gaussians[i], :])
     gaussians.xyz[start:start+g_n_gaussians[i], 0] += d
 
     # Update means of FLAME vertices with corresponding displacement
     if g_flame_model[i]:
-        vertices_start = 0 if head_avatar_index == 0 else np.cumsum(g_n_flame_vertices)[head_avatar_index - 1]
+        vertices_start = g_avatars.flame_start(i)
         vertices = g_flame_model[i].verts[0].cpu().numpy()
         vertices[:, 0] += d
-        flame_vertices.xyz[vertices_start:g_n_flame_vertices[i], :] = vertices
+        gaussians.xyz[vertices_start:vertices_start+g_n_flame_vertices[i], :] = vertices
+        g_renderer.mark_dirty(vertices_start, vertices_start+g_n_flame_vertices[i], "xyz")
 
     # Handling case for which there are no hair strands. Able to open a generic gaussian ply
     # And the case where there's zero frequency or amplitude
@@ -646,8 +789,8 @@ def update_means(head_avatar_index):
             gaussians.scale[start:start+g_n_hair_gaussians[i], :] = scale_curls.reshape(-1,3)*g_hair_scale[i]
     
     else:
-        gaussians.rot[start:start+g_n_gaussians[i], :] = rot[:g_n_gaussians[i], :]
-        gaussians.scale[start:start+g_n_gaussians[i], :] = scale[:g_n_gaussians[i], :]
+        g_head_avatars[i].get_into("rot", gaussians.rot[start:start+g_n_gaussians[i], :])
+        g_head_avatars[i].get_into("scale", gaussians.scale[start:start+g_n_gaussians[i], :])
     g_means[i] = np.mean(gaussians.xyz[start:start+g_n_gaussians[i]], axis=0)
 
 def get_displacement(head_avatar_index):
@@ -751,37 +894,39 @@ def cut_hair():
     # Compute distances between each head avatar mean and its closest point on the ray
     distances = np.linalg.norm(hair_gaussians - closest_points_on_ray, axis=1)
 
-    # Zero the opacity of the closest hair gaussians
-    g_head_avatars[i].opacity[:g_n_hair_gaussians[i], :][distances < g_max_cutting_distance, :] = 0
-    gaussians.opacity[start:start+g_n_hair_gaussians[i], :][distances < g_max_cutting_distance, :] = 0
-
-    # Make sure there are no flying strands
-    for j in range(g_n_strands[i]):
-        k = np.where(g_head_avatars[i].opacity[j*g_n_gaussians_per_strand[i]:(j+1)*g_n_gaussians_per_strand[i], :] == 0)[0]
-        if len(k) > 0:
-            k = k[0]
-            g_head_avatars[i].opacity[j*g_n_gaussians_per_strand[i]+k:(j+1)*g_n_gaussians_per_strand[i], :] = 0
-            gaussians.opacity[start+j*g_n_gaussians_per_strand[i]+k:start+(j+1)*g_n_gaussians_per_strand[i], :] = 0
-
-            if k != 0:
-                g_head_avatars[i].xyz[j*g_n_gaussians_per_strand[i]+k:(j+1)*g_n_gaussians_per_strand[i], :] = g_head_avatars[i].xyz[j*g_n_gaussians_per_strand[i]+k-1, :]
-                gaussians.xyz[start+j*g_n_gaussians_per_strand[i]+k:start+(j+1)*g_n_gaussians_per_strand[i], :] = gaussians.xyz[start+j*g_n_gaussians_per_strand[i]+k, :]
+    # Zero the opacity of the closest hair gaussians, and of the rest of their strands so that
+    # there are no flying strands. The hair is read from the avatar as it is (materialized
+    # once it has edits), and only the rows that change are stored as edits
+    n_strands, n_gaussians_per_strand = g_n_strands[i], g_n_gaussians_per_strand[i]
+    g_renderer.mark_dirty(start, start+g_n_hair_gaussians[i], "xyz", "opacity")
+    hair_opacity = g_head_avatars[i].opacity[:g_n_hair_gaussians[i], 0]
+    hair_xyz = g_head_avatars[i].xyz[:g_n_hair_gaussians[i]]
+    cut = ((distances < g_max_cutting_distance) | (hair_opacity == 0)).reshape(n_strands, n_gaussians_per_strand)
+    # first cut Gaussian of every strand, the strand length if none is
+    first = np.where(cut.any(axis=1), np.argmax(cut, axis=1), n_gaussians_per_strand)
+    rows = np.flatnonzero(np.arange(n_gaussians_per_strand) >= first[:, None])
+    gaussians.opacity[start+rows, :] = 0
+    zeroed = rows[hair_opacity[rows] != 0]
+    if len(zeroed):
+        g_head_avatars[i].set("opacity", zeroed, 0)
+
+    # The cut part of a strand collapses onto the Gaussian before it
+    strands = rows // n_gaussians_per_strand
+    collapsed = first[strands] > 0
+    rows, first_rows = rows[collapsed], strands[collapsed] * n_gaussians_per_strand + first[strands[collapsed]]
+    gaussians.xyz[start+rows, :] = gaussians.xyz[start+first_rows, :]
+    xyz = hair_xyz[first_rows - 1]
+    moved = np.any(hair_xyz[rows] != xyz, axis=1)
+    if np.any(moved):
+        g_head_avatars[i].set("xyz", rows[moved], xyz[moved])
 
 
 def reset_cut():
-    file_path = g_file_paths[g_selected_head_avatar_index]
-    if file_path:
-        try:
-            # Set opacity from original head avatar
-            head_avatar, _ = utils.util_gau.load_ply(file_path)
-            xyz, _, _, opacity, _ = head_avatar.get_data()
-            i = g_selected_head_avatar_index
-            start = get_start_index(i)
-            g_head_avatars[i].opacity[:g_n_hair_gaussians[i], :] = opacity[:g_n_hair_gaussians[i], :]
-            g_head_avatars[i].xyz = xyz
-            update_hair_opacity()
-        except RuntimeError as e:
-                pass
+    # The loaded avatar is kept as the base of the edits, so the file is not read again
+    i = g_selected_head_avatar_index
+    g_head_avatars[i].reset("opacity", 0, g_n_hair_gaussians[i])
+    g_head_avatars[i].reset("xyz")
+    update_hair_opacity()
 
 def color_hair():
     # Get means, colors, and opacities of selected head avatar
@@ -834,10 +979,11 @@ def color_hair():
     final_indices = np.where(opacity_mask)[0][np.where(x_mask & y_mask & z_mask)[0][np.where(distance_mask)[0]]]
 
     # Color the closest hair gaussians
-    g_head_avatars[i].sh[final_indices, 0:3] = list((np.asarray(g_selected_color) - 0.5) / 0.28209)
+    g_head_avatars[i].set("sh", final_indices, (np.asarray(g_selected_color) - 0.5) / 0.28209, columns=slice(0, 3))
     gaussians.sh[start:start+g_n_gaussians[i], :][final_indices, 0:3] = list((np.asarray(g_selected_color) - 0.5) / 0.28209)
+    g_renderer.mark_dirty(start, start+g_n_gaussians[i], "sh")
     if not g_keep_sh:
-        g_head_avatars[i].sh[final_indices, 3:] = 0
+        g_head_avatars[i].set("sh", final_indices, 0, columns=slice(3, None))
         gaussians.sh[start:start+g_n_gaussians[i], :][final_indices, 3:] = 0
 
 def reset_coloring():
@@ -851,7 +997,7 @@ def reset_coloring():
 def extract_hairstyle_from_file(file_path):
     if file_path:
         try:
-            head_avatar, (n_strands, n_gaussians_per_strand) = utils.util_gau.load_ply(file_path)
+            head_avatar, (n_strands, n_gaussians_per_strand), _ = load_ply_cached(file_path)
             n_hair_gaussians = n_strands * n_gaussians_per_strand
             xyz, rot, scale, opacity, sh = head_avatar.get_data()
             return (xyz[:n_hair_gaussians, :], rot[:n_hair_gaussians, :], scale[:n_hair_gaussians, :], opacity[:n_hair_gaussians, :], sh[:n_hair_gaussians, :]), (n_strands, n_gaussians_per_strand)
@@ -862,15 +1008,15 @@ def extract_hairstyle_from_avatar(j):
     start = get_start_index(j)
     n_strands, n_gaussians_per_strand = g_n_strands[j], g_n_gaussians_per_strand[j]
     n_hair_gaussians = n_strands * n_gaussians_per_strand
-    xyz, rot, scale, opacity, sh = g_head_avatars[j].get_data()
-    xyz = xyz[:n_hair_gaussians, :]
-    rot = rot[:n_hair_gaussians, :]
-    scale = scale[:n_hair_gaussians, :]
-    opacity = opacity[:n_hair_gaussians, :]
+    xyz = g_head_avatars[j].get_xyz(0, n_hair_gaussians)
+    rot = g_head_avatars[j].get_rot(0, n_hair_gaussians)
+    scale = g_head_avatars[j].get_scale(0, n_hair_gaussians)
+    opacity = g_head_avatars[j].get_opacity(0, n_hair_gaussians)
     sh = np.copy(gaussians.sh[start:start+n_hair_gaussians, :])
     return (xyz, rot, scale, opacity, sh), (n_strands, n_gaussians_per_strand)
 
 def update_hairstyle(hairstyle_points, hairstyle_constants, j):
+    global gaussians
     i = g_selected_head_avatar_index
     start = get_start_index(i)
 
@@ -878,19 +1024,29 @@ def update_hairstyle(hairstyle_points, hairstyle_constants, j):
     n_strands, n_gaussians_per_strand = hairstyle_constants
     n_hair_gaussians = n_strands * n_gaussians_per_strand
 
-    # Update gaussians sent to renderer
-    gaussians.xyz = np.vstack([gaussians.xyz[:start, :], xyz, gaussians.xyz[start+g_n_hair_gaussians[i]:, :]])
-    gaussians.rot = np.vstack([gaussians.rot[:start, :], rot, gaussians.rot[start+g_n_hair_gaussians[i]:, :]])
-    gaussians.scale = np.vstack([gaussians.scale[:start, :], scale, gaussians.scale[start+g_n_hair_gaussians[i]:, :]])
-    gaussians.opacity = np.vstack([gaussians.opacity[:start, :], opacity, gaussians.opacity[start+g_n_hair_gaussians[i]:, :]])
-    gaussians.sh = np.vstack([gaussians.sh[:start, :], sh, gaussians.sh[start+g_n_hair_gaussians[i]:, :]])
+    # Update gaussians sent to renderer, only the slab of the avatar changes. The head rows
+    # after the hair shift within it, and it only moves if the new hair does not fit
+    n_gaussians = g_n_gaussians[i] + n_hair_gaussians - g_n_hair_gaussians[i]
+    head = g_arena.rows(start).rows(g_n_hair_gaussians[i], g_n_gaussians[i])
+    head = util_gau.GaussianData.from_buffers(np.copy(head.geometry), np.copy(head.opacity), np.copy(head.sh))
+    g_renderer.mark_dirty(start, start + max(g_n_gaussians[i], n_gaussians))
+    start = g_arena.resize(start, n_gaussians)
+    g_arena.write(start, util_gau.GaussianData(xyz, rot, scale, opacity, sh))
+    g_arena.write(start, head, n_hair_gaussians)
+    g_renderer.mark_dirty(start, start + n_gaussians)
+    g_avatars[i].start = start
+    gaussians = g_arena.data
 
     # Update gaussian object
-    g_head_avatars[i].xyz = np.vstack([xyz, g_head_avatars[i].xyz[g_n_hair_gaussians[i]:, :]])
-    g_head_avatars[i].rot = np.vstack([rot, g_head_avatars[i].rot[g_n_hair_gaussians[i]:, :]])
-    g_head_avatars[i].scale = np.vstack([scale, g_head_avatars[i].scale[g_n_hair_gaussians[i]:, :]])
-    g_head_avatars[i].opacity = np.vstack([opacity, g_head_avatars[i].opacity[g_n_hair_gaussians[i]:, :]])
-    g_head_avatars[i].sh = np.vstack([sh, g_head_avatars[i].sh[g_n_hair_gaussians[i]:, :]])
+    # The new hairstyle and the edited head become the base of the avatar
+    head_avatar = g_head_avatars[i]
+    g_head_avatars[i] = utils.util_avatar.AvatarState(utils.util_gau.GaussianData(
+        np.vstack([xyz, head_avatar.xyz[g_n_hair_gaussians[i]:, :]]),
+        np.vstack([rot, head_avatar.rot[g_n_hair_gaussians[i]:, :]]),
+        np.vstack([scale, head_avatar.scale[g_n_hair_gaussians[i]:, :]]),
+        np.vstack([opacity, head_avatar.opacity[g_n_hair_gaussians[i]:, :]]),
+        np.vstack([sh, head_avatar.sh[g_n_hair_gaussians[i]:, :]]),
+    ))
 
     # Update properties
     g_means[i] = np.mean(g_head_avatars[i].xyz, axis=0)
@@ -911,6 +1067,7 @@ def update_hairstyle(hairstyle_points, hairstyle_constants, j):
     g_renderer.update_n_gaussians(g_n_gaussians[g_selected_head_avatar_index])
     g_renderer.update_n_hair_gaussians(g_n_hair_gaussians[g_selected_head_avatar_index])
     update_avatar_planes()
+    update_sort_layout()
 
     # Update features
     update_displacements_and_opacities()
@@ -931,10 +1088,11 @@ def update_flame_head_gaussians(reset_to_zero=False, from_file=False):
 
     g_flame_model[i].update_mesh_by_param_dict(g_flame_param[i])
 
-    g_head_avatars[i].xyz[g_n_hair_gaussians[i]:, :] = g_flame_model[i].get_xyz.detach().numpy().astype(np.float32)
+    g_head_avatars[i].set("xyz", slice(g_n_hair_gaussians[i], None), g_flame_model[i].get_xyz.detach().numpy().astype(np.float32))
     gaussians.rot[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = g_flame_model[i].get_rotation.detach().numpy().astype(np.float32)
     gaussians.scale[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = g_flame_model[i].get_scaling.detach().numpy().astype(np.float32)
     gaussians.opacity[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = g_flame_model[i].get_opacity.detach().numpy().astype(np.float32)
+    g_renderer.mark_dirty(start+g_n_hair_gaussians[i], start+g_n_gaussians[i], "rot", "scale", "opacity", "sh")
     sh = g_flame_model[i].get_features.detach().numpy().astype(np.float32)
     sh = sh.reshape(sh.shape[0], -1)
     gaussians.sh[start+g_n_hair_gaussians[i]:start+g_n_gaussians[i], :] = sh
@@ -1006,7 +1164,7 @@ def update_flame_hair_gaussians():
     posed_flame_hair = posed_flame_hair + translation
 
     # Update means
-    g_head_avatars[i].xyz[:g_n_hair_gaussians[i], :] = posed_flame_hair
+    g_head_avatars[i].set("xyz", slice(0, g_n_hair_gaussians[i]), posed_flame_hair)
 
 def compute_binding(flame_model, hair_xyz, hairstyle_constants):
     # Extract shaped vertices
@@ -1142,39 +1300,28 @@ def update_avatar_planes():
 
 def update_flame_vertices():
     i = g_selected_head_avatar_index
-    vertices_start = 0 if i == 0 else np.cumsum(g_n_flame_vertices)[i - 1]
+    vertices_start = g_avatars.flame_start(i)
 
     vertices = g_flame_model[i].flame_model.verts[0].cpu().numpy() 
     vertices[:, 0] += get_displacement(i)
-    flame_vertices.xyz[vertices_start:g_n_flame_vertices[i], :] = vertices
+    gaussians.xyz[vertices_start:vertices_start+g_n_flame_vertices[i], :] = vertices
+    g_renderer.mark_dirty(vertices_start, vertices_start+g_n_flame_vertices[i], "xyz")
 
 def update_flame_opacities():
     i = g_selected_head_avatar_index
-    vertices_start = 0 if i == 0 else np.cumsum(g_n_flame_vertices)[i - 1]
+    vertices_start = g_avatars.flame_start(i)
+    g_renderer.mark_dirty(vertices_start, vertices_start+g_n_flame_vertices[i], "opacity", "scale", "sh")
 
     if g_show_flame_vertices[i]:
-        flame_vertices.opacity[vertices_start:g_n_flame_vertices[i], :] = 1
-        flame_vertices.sh[g_binding[i], 0:3] = ((np.array([0, 1, 0]) - 0.5) / 0.28209).T
-        flame_vertices.scale[g_binding[i], :] = 0.002
+        gaussians.opacity[vertices_start:vertices_start+g_n_flame_vertices[i], :] = 1
+        gaussians.sh[vertices_start+g_binding[i], 0:3] = ((np.array([0, 1, 0]) - 0.5) / 0.28209).T
+        gaussians.scale[vertices_start+g_binding[i], :] = 0.002
     else:
-        flame_vertices.opacity[vertices_start:g_n_flame_vertices[i], :] = 0
+        gaussians.opacity[vertices_start:vertices_start+g_n_flame_vertices[i], :] = 0
 
 def render_gaussians():
-    if flame_vertices is None:
-        g_renderer.update_gaussian_data(gaussians)
-        return
-
-    # scene = gaussians + flame_vertices
-    xyz = np.vstack([gaussians.xyz, flame_vertices.xyz]).astype(np.float32)
-    rot = np.vstack([gaussians.rot, flame_vertices.rot]).astype(np.float32)
-    scale = np.vstack([gaussians.scale, flame_vertices.scale]).astype(np.float32)
-    opacity = np.vstack([gaussians.opacity, flame_vertices.opacity]).astype(np.float32)
-    flame_vertices.sh = np.hstack([flame_vertices.sh, np.zeros((flame_vertices.sh.shape[0], gaussians.sh.shape[1] - flame_vertices.sh.shape[1]))]).astype(np.float32)
-    sh = np.vstack([gaussians.sh, flame_vertices.sh]).astype(np.float32)
-
-    scene = util_gau.GaussianData(xyz, rot, scale, opacity, sh)
-
-    g_renderer.update_gaussian_data(scene)
+    g_renderer.update_gaussian_data(gaussians)
+    select_sort_backend()
 
 ########
 # Utils
@@ -1302,16 +1449,71 @@ def update_camera_intrin_lazy():
     if g_camera.is_intrin_dirty:
         g_renderer.update_camera_intrin(g_camera)
         g_camera.is_intrin_dirty = False
+        # the culling frustum changed
+        g_sort_scheduler.invalidate()
+
+def sort_and_update_lazy():
+    if g_sort_scheduler.should_sort(g_camera.get_view_matrix(), g_renderer.scene_version):
+        g_renderer.sort_and_update(g_camera)
+
+def select_sort_backend():
+    sort_backend = g_sort_backend_tables[g_sort_backend]
+    if sort_backend == "auto":
+        # Calibrated once, on the first scene that is loaded. The Control window can run it again
+        if not g_sort_calibrated_n and g_sort_calibration is None:
+            calibrate_sort_backend()
+        sort_backend = g_sort_auto_backend
+    g_renderer.set_sort_backend(sort_backend)
+
+def calibrate_sort_backend():
+    global g_sort_calibration
+    # Times the backends on the sort thread, the fastest is picked once collect_sort_calibration sees it done
+    n = len(g_renderer.gaussians) if g_renderer.gaussians is not None else 0
+    if n and g_sort_calibration is None:
+        g_sort_calibration = (g_renderer.submit_sort_calibration(g_camera.get_view_matrix()), n)
+
+def collect_sort_calibration():
+    global g_sort_calibration, g_sort_auto_backend, g_sort_timings, g_sort_calibrated_n
+    if g_sort_calibration is None or not g_sort_calibration[0].done():
+        return
+    (g_sort_auto_backend, g_sort_timings), g_sort_calibrated_n = g_sort_calibration[0].result(), g_sort_calibration[1]
+    g_sort_calibration = None
+    select_sort_backend()
 
 def update_activated_renderer_state(gaussians: utils.util_gau.GaussianData):
+    if g_renderer.compact_layout != g_compact_layout:
+        g_renderer.set_compact_layout(g_compact_layout)
     render_gaussians()
+    select_sort_backend()
     g_renderer.sort_and_update(g_camera)
+    g_sort_scheduler.invalidate()
     g_renderer.set_scale_modifier(g_scale_modifier)
-    g_renderer.set_render_mod(g_render_mode - 3)
+    g_renderer.set_render_mod(g_render_mode - 5)
     g_renderer.update_camera_pose(g_camera)
     g_renderer.update_camera_intrin(g_camera)
     g_renderer.set_render_reso(g_camera.w, g_camera.h)
 
+def read_frame(window):
+    width, height = glfw.get_framebuffer_size(window)
+    gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+    gl.glReadBuffer(gl.GL_BACK)
+    bufferdata = gl.glReadPixels(0, 0, width, height, gl.GL_RGB, gl.GL_UNSIGNED_BYTE)
+    return np.frombuffer(bufferdata, np.uint8, -1).reshape(height, width, 3)
+
+def compare_compact_layout(window):
+    # Draws the current view in the full precision and in the compact layout, and returns the PSNR between them
+    frames = []
+    for compact in [False, True]:
+        g_renderer.set_compact_layout(compact)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+        g_renderer.draw()
+        frames.append(read_frame(window).astype(np.float64))
+    g_renderer.set_compact_layout(g_compact_layout)
+    gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+    g_renderer.draw()
+    mse = np.mean((frames[0] - frames[1]) ** 2)
+    return np.inf if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
 def window_resize_callback(window, width, height):
     gl.glViewport(0, 0, width, height)
     g_camera.update_resolution(height, width)
@@ -1319,9 +1521,9 @@ def window_resize_callback(window, width, height):
 
 
 def main():
-    global g_camera, g_renderer, g_renderer_list, g_renderer_idx, g_scale_modifier, g_auto_sort, \
+    global g_camera, g_renderer, g_renderer_list, g_renderer_idx, g_scale_modifier, g_auto_sort, g_sort_backend, \
         g_show_control_win, g_show_help_win, g_show_camera_win, g_show_flame_win, \
-        g_render_mode, g_render_mode_tables
+        g_render_mode, g_render_mode_tables, g_compact_layout, g_compact_psnr, g_close_report, g_avatar_cache
 
     # Head Avatars Global Variables
     global gaussians, g_show_head_avatars_win, g_checkboxes, g_cutting_mode, \
@@ -1337,6 +1539,10 @@ def main():
     imgui.create_context()
     if args.hidpi:
         imgui.get_io().font_global_scale = 1.5
+    set_parallel_sort(args.sort_threads or None, args.sort_chunks)
+    g_sort_backend = g_sort_backend_tables.index(args.sort_backend)
+    g_compact_layout = args.compact_layout
+    g_avatar_cache = utils.avatar_cache.AvatarCache(args.avatar_cache_dir, args.avatar_cache_size * 2**20)
     window = impl_glfw_init()
     impl = GlfwRenderer(window)
     root = tk.Tk()  # used for file dialog
@@ -1382,6 +1588,7 @@ def main():
 
         update_camera_pose_lazy()
         update_camera_intrin_lazy()
+        collect_sort_calibration()
 
         g_renderer.draw()
 
@@ -1472,6 +1679,15 @@ def main():
                 changed, g_renderer.reduce_updates = imgui.checkbox( "reduce updates", g_renderer.reduce_updates,)
 
                 imgui.text(f"# of Gaus = {gaussians.xyz.shape[0]}")
+                imgui.text(f"last upload = {g_renderer.upload_bytes / 2**20:.2f} MB")
+                changed, g_compact_layout = imgui.checkbox("compact layout", g_compact_layout)
+                if changed:
+                    g_renderer.set_compact_layout(g_compact_layout)
+                imgui.same_line()
+                if imgui.button(label="compare layouts"):
+                    g_compact_psnr = compare_compact_layout(window)
+                if g_compact_psnr is not None:
+                    imgui.text(f"compact layout PSNR = {g_compact_psnr:.2f} dB")
                 if imgui.button(label='open ply'):
                     file_path = filedialog.askopenfilename(title="open ply",
                         initialdir="./data",
@@ -1480,6 +1696,9 @@ def main():
                     if file_path:
                         try:
                             gaussians, _ = utils.util_gau.load_ply(file_path)
+                            g_renderer.mark_dirty(0, len(gaussians))
+                            set_strand_layout([])
+                            set_avatar_layout([])
                             render_gaussians()
                             g_renderer.sort_and_update(g_camera)
                         except RuntimeError as e:
@@ -1524,7 +1743,45 @@ def main():
                         "auto sort", g_auto_sort,
                     )
                 if g_auto_sort:
-                    g_renderer.sort_and_update(g_camera)
+                    sort_and_update_lazy()
+
+                changed, g_sort_scheduler.angle_threshold = imgui.slider_float(
+                    "sort angle", g_sort_scheduler.angle_threshold, 0, np.radians(5), "re-sort angle = %.4f"
+                )
+                changed, g_sort_scheduler.translation_threshold = imgui.slider_float(
+                    "sort move", g_sort_scheduler.translation_threshold, 0, 0.1, "re-sort move = %.4f"
+                )
+                imgui.text(f"sorts performed = {g_sort_scheduler.n_sorted}, skipped = {g_sort_scheduler.n_skipped}")
+
+                changed, g_renderer.background_sort = imgui.checkbox("background sort", g_renderer.background_sort)
+                changed, g_renderer.frustum_culling = imgui.checkbox("frustum culling", g_renderer.frustum_culling)
+                if changed:
+                    g_sort_scheduler.invalidate()
+                if g_renderer.gaussians is not None:
+                    imgui.text(f"drawn = {g_renderer.index_count} / {len(g_renderer.gaussians)}")
+
+                changed, g_sort_backend = imgui.combo("sort", g_sort_backend, g_sort_backend_tables)
+                if changed:
+                    select_sort_backend()
+                imgui.text(f"sort backend = {g_renderer.sort_backend}")
+                if g_sort_backend_tables[g_sort_backend] == "auto":
+                    if imgui.button(label='calibrate'):
+                        calibrate_sort_backend()
+                    imgui.same_line()
+                    if g_sort_calibration is not None:
+                        imgui.text(f"calibrating on {g_sort_calibration[1]} Gaussians...")
+                    elif g_sort_calibrated_n:
+                        imgui.text(f"calibration on {g_sort_calibrated_n} Gaussians picked {g_sort_auto_backend}")
+                    else:
+                        imgui.text("not calibrated")
+                    if g_sort_timings:
+                        imgui.text(", ".join(f"{name} {t * 1000:.1f} ms" for name, t in g_sort_timings.items()))
+                sort_stats = get_sort_stats()
+                imgui.text(f"incremental sort: full = {sort_stats['full']}, repaired = {sort_stats['repaired']}, reused = {sort_stats['reused']}")
+                if g_sort_backend_tables[g_sort_backend] == "strand":
+                    imgui.text(f"strand sort: inverted pairs = {sort_stats['strand_inverted'] * 100:.2f}%, max inversion = {sort_stats['strand_max_inversion']:.4f}")
+                if g_sort_backend_tables[g_sort_backend] == "avatar":
+                    imgui.text(f"avatar sort: sorted = {sort_stats['avatar_sorted']}, reused = {sort_stats['avatar_reused']}, merged = {sort_stats['avatar_merged']}")
 
                 if imgui.button(label='save image'):
                     width, height = glfw.get_framebuffer_size(window)
@@ -1550,7 +1807,7 @@ def main():
                     # )
                 imgui.end()
         elif g_auto_sort:
-            g_renderer.sort_and_update(g_camera)
+            sort_and_update_lazy()
 
         if g_show_camera_win:
             imgui.begin("Camera Control", True)
@@ -1776,8 +2033,8 @@ def main():
                 )
                 if file_path:
                     try:
-                        head_avatar, head_avatar_constants = utils.util_gau.load_ply(file_path)
-                        open_head_avatar(file_path, head_avatar, head_avatar_constants, None)
+                        head_avatar, head_avatar_constants, hair_points = load_ply_cached(file_path)
+                        open_head_avatar(file_path, head_avatar, head_avatar_constants, None, hair_points)
                         update_displacements_and_opacities()
                         select_head_avatar(len(g_head_avatars) - 1)
                         render_gaussians()
@@ -1793,19 +2050,46 @@ def main():
                 )
                 if folder_path:
                     try:
-                        head_avatar, head_avatar_constants, flame_model = load_avatar_from_folder(folder_path)
-                        open_head_avatar(folder_path, head_avatar, head_avatar_constants, flame_model)
+                        head_avatar, head_avatar_constants, flame_model, hair_points = load_avatar_from_folder(folder_path)
+                        open_head_avatar(folder_path, head_avatar, head_avatar_constants, flame_model, hair_points)
                         update_displacements_and_opacities()
                         select_head_avatar(len(g_head_avatars) - 1)
                         render_gaussians()
                     except RuntimeError as e:
                         pass
 
-            # Open head avatar from folder button                
+            # Open several head avatars at once, from files or from the avatar folders in a folder
+            if imgui.button(label='Open Head Avatar Files'):
+                paths = list(filedialog.askopenfilenames(
+                    title="open plys from files",
+                    initialdir = f"./models/",
+                    filetypes=[('ply file', '.ply')]
+                ))
+            else:
+                paths = []
+
+            imgui.same_line()
+
+            if imgui.button(label='Open Head Avatar Folders'):
+                folder_path = filedialog.askdirectory(
+                    title="Select Folder of Avatar Folders",
+                    initialdir="./models/"
+                )
+                if folder_path and os.path.isfile(os.path.join(folder_path, "hair.ply")):
+                    paths = [folder_path]
+                elif folder_path:
+                    paths = [os.path.join(folder_path, name) for name in sorted(os.listdir(folder_path))
+                             if os.path.isfile(os.path.join(folder_path, name, "hair.ply"))]
+
+            if paths and open_head_avatars(paths):
+                update_displacements_and_opacities()
+                select_head_avatar(len(g_head_avatars) - 1)
+                render_gaussians()
 
             imgui.separator()
 
             # Display Head Avatar Checkboxes
+            closed = None
             for i in range(len(g_head_avatars)):
                 changed, g_checkboxes[i] = imgui.checkbox(f"Head Avatar {i + 1} ({g_file_paths[i]})", g_checkboxes[i])
                 if changed:
@@ -1816,6 +2100,20 @@ def main():
                     select_head_avatar(g_selected_head_avatar_index)
                     update_displacements_and_opacities()
                     render_gaussians()
+                imgui.same_line()
+                if imgui.button(label=f"Close Avatar##{i}"):
+                    closed = i
+
+            if closed is not None:
+                gpu_bytes = g_renderer.buffer_nbytes()
+                cpu_bytes, rows, arena_bytes = close_head_avatar(closed)
+                render_gaussians()
+                # the GPU buffers are reallocated by the upload once the compacted scene needs much less of them
+                gpu_bytes -= g_renderer.buffer_nbytes()
+                g_close_report = f"Closed Head Avatar {closed + 1}: {cpu_bytes / 2**20:.1f} MB of avatar state, {rows} scene rows " \
+                                 f"({arena_bytes / 2**20:.1f} MB of scene arena, {gpu_bytes / 2**20:.1f} MB of GPU buffers given back)"
+            if g_close_report is not None:
+                imgui.text(g_close_report)
 
             imgui.end()
 
@@ -2125,6 +2423,12 @@ if __name__ == "__main__":
     global args
     parser = argparse.ArgumentParser(description="Dynamic Gaussian Visualizer")
     parser.add_argument("--hidpi", action="store_true", help="Enable HiDPI scaling for the interface.")
+    parser.add_argument("--sort_backend", default="auto", choices=["auto"] + get_sort_backends(), help="Depth sort backend (auto = fastest exact backend on the loaded scene).")
+    parser.add_argument("--sort_threads", type=int, default=0, help="Threads used by the parallel sort (0 = all cores).")
+    parser.add_argument("--sort_chunks", type=int, default=0, help="Chunks the parallel sort splits the scene into (0 = one per thread).")
+    parser.add_argument("--compact_layout", action="store_true", help="Store rotations, scales and SH as half floats and 8 bit steps on the GPU.")
+    parser.add_argument("--avatar_cache_dir", default=utils.avatar_cache.DEFAULT_DIRECTORY, help="Directory of the cache of decoded avatar files.")
+    parser.add_argument("--avatar_cache_size", type=int, default=4096, help="Size limit of the avatar cache in MB (0 = no cache).")
     args = parser.parse_args()
 
     main()
@@ -1,6 +1,12 @@
 from OpenGL import GL as gl
 from utils import util, util_gau
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+from functools import partial
+import dataclasses
+import threading
 
 try:
     from OpenGL.raw.WGL.EXT.swap_control import wglSwapIntervalEXT
@@ -9,7 +15,7 @@ except:
 
 
 _sort_buffer_xyz = None
-_sort_buffer_gausid = None  # used to tell whether gaussian is reloaded
+_sort_buffer_gaus = None  # used to tell whether gaussian is reloaded
 
 def _sort_gaussian_cpu(gaus, view_mat):
     xyz = np.asarray(gaus.xyz)
@@ -25,10 +31,10 @@ def _sort_gaussian_cpu(gaus, view_mat):
 
 def _sort_gaussian_cupy(gaus, view_mat):
     import cupy as cp
-    global _sort_buffer_gausid, _sort_buffer_xyz
-    if _sort_buffer_gausid != id(gaus):
+    global _sort_buffer_gaus, _sort_buffer_xyz
+    if _sort_buffer_gaus is not gaus:
         _sort_buffer_xyz = cp.asarray(gaus.xyz)
-        _sort_buffer_gausid = id(gaus)
+        _sort_buffer_gaus = gaus
 
     xyz = _sort_buffer_xyz
     view_mat = cp.asarray(view_mat)
@@ -44,10 +50,11 @@ def _sort_gaussian_cupy(gaus, view_mat):
 
 
 def _sort_gaussian_torch(gaus, view_mat):
-    global _sort_buffer_gausid, _sort_buffer_xyz
-    if _sort_buffer_gausid != id(gaus):
+    import torch
+    global _sort_buffer_gaus, _sort_buffer_xyz
+    if _sort_buffer_gaus is not gaus:
         _sort_buffer_xyz = torch.tensor(gaus.xyz).cuda()
-        _sort_buffer_gausid = id(gaus)
+        _sort_buffer_gaus = gaus
 
     xyz = _sort_buffer_xyz
     view_mat = torch.tensor(view_mat).cuda()
@@ -58,26 +65,529 @@ def _sort_gaussian_torch(gaus, view_mat):
     return index
 
 
-# Decide which sort to use. Commented as now we are using torch and will fail with nvidia cards
-_sort_gaussian = _sort_gaussian_cpu
-# try:
-#     import torch
-#     if not torch.cuda.is_available():
-#         raise ImportError
-#     print("Detect torch cuda installed, will use torch as sorting backend")
-#     _sort_gaussian = _sort_gaussian_torch
-# except ImportError:
-#     try:
-#         import cupy as cp
-#         print("Detect cupy installed, will use cupy as sorting backend")
-#         _sort_gaussian = _sort_gaussian_cupy
-#     except ImportError:
-#         _sort_gaussian = _sort_gaussian_cpu
+# Tuning of the incremental sort: views rotated or moved further than this since the
+# previous sort are sorted from scratch
+INCREMENTAL_SORT_MAX_ANGLE = np.radians(15)
+INCREMENTAL_SORT_MAX_TRANSLATION = 0.5
+
+_sort_prev_index = None
+_sort_prev_view = None
+_sort_stats = {"full": 0, "repaired": 0, "reused": 0, "strand_inverted": 0., "strand_max_inversion": 0.,
+               "avatar_sorted": 0, "avatar_reused": 0, "avatar_merged": 0, "visible": 0}
+
+def _repair_sorted_order(keys):
+    # Positions of the float32 keys in ascending order, equal keys keep their order. Every key
+    # is packed with its position into one uint64, which NumPy sorts by value faster than it
+    # argsorts the keys. Even a small camera move leaves about every other neighbouring pair
+    # of the previous order inverted, so this does not look for the displaced keys first
+    bits = keys.view(np.int32)
+    # flipping the sign bit of positive floats and every bit of negative ones orders them as unsigned integers
+    packed = (bits.view(np.uint32) ^ ((bits >> 31).view(np.uint32) | np.uint32(0x80000000))).astype(np.uint64)
+    packed <<= np.uint64(32)
+    packed |= np.arange(len(keys), dtype=np.uint64)
+    packed.sort()
+    # the low words are the positions
+    return packed.astype(np.uint32)
+
+def _sort_gaussian_incremental(gaus, view_mat):
+    global _sort_prev_index, _sort_prev_view
+    xyz = np.asarray(gaus.xyz)
+    view_mat = np.asarray(view_mat)
+    depth = xyz @ view_mat[2, :3] + view_mat[2, 3]
+
+    prev_index = _sort_prev_index
+    small_move = False
+    if prev_index is not None and len(prev_index) == len(depth) and depth.dtype == np.float32 and len(depth) < 2**32:
+        angle, translation = util.view_change(_sort_prev_view, view_mat)
+        small_move = angle <= INCREMENTAL_SORT_MAX_ANGLE and translation <= INCREMENTAL_SORT_MAX_TRANSLATION
+
+    path = "full"
+    index = None
+    if small_move:
+        # Depths in the previous order, Gaussians at equal depths stay in the order they were drawn in
+        keys = depth[prev_index]
+        if not np.any(keys[1:] < keys[:-1]):
+            path = "reused"
+            index = prev_index
+        else:
+            path = "repaired"
+            index = np.take(prev_index, _repair_sorted_order(keys))
+    if index is None:
+        index = np.argsort(depth)
+
+    _sort_stats[path] += 1
+    _sort_prev_index = index
+    _sort_prev_view = view_mat
+    return index.astype(np.int32).reshape(-1, 1)
+
+def get_sort_stats():
+    return dict(_sort_stats)
+
+
+def _quantize_depth(depth, bits):
+    # Maps the scene's depth range onto unsigned integer keys, so that keys of
+    # Gaussians closer than one quantization step may tie
+    near, far = depth.min(), depth.max()
+    levels = (1 << bits) - 1
+    scale = levels / max(float(far) - float(near), 1e-12)
+    keys = (depth.astype(np.float64) - near) * scale
+    keys = np.clip(keys, 0, levels)
+    step = (float(far) - float(near)) / levels
+    return keys.astype(np.uint16 if bits == 16 else np.uint32), step
+
+def _radix_argsort(keys):
+    # LSD radix sort on 16-bit digits: NumPy's stable sort is a counting/radix sort
+    # for 16-bit integers, so every pass is O(N)
+    if keys.dtype == np.uint16:
+        return np.argsort(keys, kind='stable')
+    index = np.argsort((keys & 0xFFFF).astype(np.uint16), kind='stable')
+    high = (keys[index] >> 16).astype(np.uint16)
+    return index[np.argsort(high, kind='stable')]
+
+def _sort_gaussian_radix(gaus, view_mat, bits=16):
+    xyz = np.asarray(gaus.xyz)
+    view_mat = np.asarray(view_mat)
+    depth = xyz @ view_mat[2, :3] + view_mat[2, 3]
+    if len(depth) == 0:
+        return np.zeros((0, 1), dtype=np.int32)
+
+    keys, _ = _quantize_depth(depth, bits)
+    index = _radix_argsort(keys)
+    index = index.astype(np.int32).reshape(-1, 1)
+    return index
+
+
+# (start row, n_strands, n_gaussians_per_strand) of every strand-major hair block in the scene
+_sort_strand_layout = []
+
+def set_strand_layout(strand_layout):
+    global _sort_strand_layout
+    _sort_strand_layout = list(strand_layout)
+
+def _sort_gaussian_strand(gaus, view_mat):
+    xyz = np.asarray(gaus.xyz)
+    view_mat = np.asarray(view_mat)
+    depth = xyz @ view_mat[2, :3] + view_mat[2, 3]
+    n = len(depth)
+
+    layout = [(int(start), int(n_strands), int(n_per_strand)) for start, n_strands, n_per_strand in _sort_strand_layout
+              if n_strands * n_per_strand > 0 and start + n_strands * n_per_strand <= n]
+    if len(layout) == 0:
+        return _sort_gaussian_cpu(gaus, view_mat)
+
+    # Gaussians outside of the hair blocks are sorted individually
+    individual = np.ones(n, dtype=bool)
+    strand_keys, strand_rows = [], []
+    for start, n_strands, n_per_strand in layout:
+        end = start + n_strands * n_per_strand
+        individual[start:end] = False
+        rows = np.arange(start, end, dtype=np.int32).reshape(n_strands, n_per_strand)
+        # Whole strands are ordered by their mean depth...
+        strand_keys.append(depth[start:end].reshape(n_strands, n_per_strand).mean(axis=1))
+        # ...and walked from root to tip or tip to root by projecting the view
+        # direction onto the strand direction
+        direction = xyz[start + n_per_strand - 1:end:n_per_strand] - xyz[start:end:n_per_strand]
+        reverse = direction @ view_mat[2, :3] < 0
+        rows[reverse] = rows[reverse, ::-1]
+        strand_rows.append(rows)
+    individual = np.flatnonzero(individual).astype(np.int32)
+    individual = individual[np.argsort(depth[individual])]
+
+    strand_keys = np.concatenate(strand_keys)
+    strand_lengths = np.concatenate([np.full(len(rows), rows.shape[1], dtype=np.int32) for rows in strand_rows])
+    order = np.argsort(strand_keys)
+    strand_keys = strand_keys[order]
+    strand_lengths = strand_lengths[order]
+
+    # Merge the strand sequence into the individual sequence: every strand is
+    # inserted as one block in front of the first individual Gaussian behind it
+    insert_at = np.searchsorted(depth[individual], strand_keys, side='right').astype(np.int32)
+    hair_before = np.zeros(len(order) + 1, dtype=np.int32)
+    np.cumsum(strand_lengths, out=hair_before[1:])
+    index = np.empty(n, dtype=np.int32)
+
+    individual_pos = np.arange(len(individual), dtype=np.int32)
+    index[individual_pos + hair_before[np.searchsorted(insert_at, individual_pos, side='right')]] = individual
+
+    block_start = (insert_at + hair_before[:-1])[np.argsort(order)]
+    first = 0
+    for rows in strand_rows:
+        # strands of one block share their length, so their output slots form a 2D grid
+        starts = block_start[first:first + len(rows)]
+        index[starts[:, None] + np.arange(rows.shape[1], dtype=np.int32)] = rows
+        first += len(rows)
+
+    # Blending error of the approximation against the exact depth order
+    sorted_depth = depth[index]
+    inversions = sorted_depth[:-1] - sorted_depth[1:]
+    _sort_stats["strand_inverted"] = np.count_nonzero(inversions > 0) / max(n - 1, 1)
+    _sort_stats["strand_max_inversion"] = max(float(inversions.max(initial=0)), 0.)
+
+    return index.reshape(-1, 1)
+
+
+# Avatars are kept sorted on their own and only re-sorted when their Gaussians moved,
+# or when the view turned or moved (relative to the avatar's distance) past these limits
+AVATAR_SORT_MAX_ANGLE = np.radians(0.5)
+AVATAR_SORT_MAX_RELATIVE_TRANSLATION = 0.002
+
+# (start row, n_gaussians) of every avatar in the scene
+_sort_avatar_layout = []
+# (start, end) of every segment: {"view", "center", "keys" (depth at that view, ascending), "index"}
+_sort_avatar_cache = {}
+# (segments, keys, index) of the last merged order
+_sort_avatar_merged = None
+# xyz row ranges the renderer updated since the last avatar sort, None if the scene was replaced
+_sort_avatar_dirty = None
+_sort_avatar_lock = threading.Lock()
+# past this many ranges the whole scene is treated as moved
+AVATAR_SORT_MAX_DIRTY_RANGES = 1024
+
+def set_avatar_layout(avatar_layout):
+    global _sort_avatar_layout
+    _sort_avatar_layout = list(avatar_layout)
+
+def _mark_avatar_sort_dirty(ranges):
+    global _sort_avatar_dirty
+    with _sort_avatar_lock:
+        if ranges is None or _sort_avatar_dirty is None or len(_sort_avatar_dirty) + len(ranges) > AVATAR_SORT_MAX_DIRTY_RANGES:
+            _sort_avatar_dirty = None
+        else:
+            _sort_avatar_dirty.extend(ranges)
+
+def _avatar_segments(n):
+    # Avatar row ranges plus the rows that belong to no avatar (e.g. FLAME vertices)
+    avatars = sorted((int(start), int(start + count)) for start, count in _sort_avatar_layout
+                     if count > 0 and start + count <= n)
+    segments = []
+    covered = 0
+    for start, end in avatars:
+        if start < covered:
+            continue
+        if start > covered:
+            segments.append((covered, start))
+        segments.append((start, end))
+        covered = end
+    if covered < n:
+        segments.append((covered, n))
+    return segments
+
+def _sort_gaussian_avatar(gaus, view_mat):
+    global _sort_avatar_cache, _sort_avatar_merged, _sort_avatar_dirty
+    xyz = np.asarray(gaus.xyz)
+    view_mat = np.asarray(view_mat)
+    with _sort_avatar_lock:
+        dirty, _sort_avatar_dirty = _sort_avatar_dirty, []
+
+    segments = _avatar_segments(len(xyz))
+    cache = {}
+    changed = []
+    for start, end in segments:
+        entry = _sort_avatar_cache.get((start, end))
+        moved = dirty is None or any(s < end and e > start for s, e in dirty)
+        if entry is not None and not moved:
+            angle, translation = util.view_change(entry["view"], view_mat)
+            distance = np.linalg.norm(view_mat[:3, :3] @ entry["center"] + view_mat[:3, 3])
+            if angle <= AVATAR_SORT_MAX_ANGLE and translation <= AVATAR_SORT_MAX_RELATIVE_TRANSLATION * distance:
+                cache[(start, end)] = entry
+                _sort_stats["avatar_reused"] += 1
+                continue
+        depth = xyz[start:end] @ view_mat[2, :3] + view_mat[2, 3]
+        order = np.argsort(depth)
+        entry = {
+            "view": view_mat,
+            "center": np.mean(xyz[start:end], axis=0) if end > start else np.zeros(3),
+            "keys": depth[order],
+            "index": (order + start).astype(np.int32),
+        }
+        cache[(start, end)] = entry
+        changed.append((start, end))
+        _sort_stats["avatar_sorted"] += 1
+    _sort_avatar_cache = cache
+
+    merged = _sort_avatar_merged
+    if merged is not None and merged[0] == segments and not changed:
+        return merged[2]
+    if merged is not None and merged[0] == segments and len(changed) < len(segments):
+        # the rows of the re-sorted segments are taken out of the merged order, and their
+        # new runs merged back into the rest, which stays sorted
+        merged_index = merged[2].ravel()
+        if len(changed) == 1:
+            start, end = changed[0]
+            keep = (merged_index < start) | (merged_index >= end)
+        else:
+            stale = np.zeros(len(xyz), dtype=bool)
+            for start, end in changed:
+                stale[start:end] = True
+            keep = ~stale[merged_index]
+        rest_keys, rest_index = merged[1][keep], merged_index[keep]
+        new_keys = np.concatenate([cache[segment]["keys"] for segment in changed])
+        new_index = np.concatenate([cache[segment]["index"] for segment in changed])
+        if len(changed) > 1:
+            order = np.argsort(new_keys)
+            new_keys, new_index = new_keys[order], new_index[order]
+        pos = np.searchsorted(rest_keys, new_keys, side='right') + np.arange(len(new_keys))
+        rest_pos = np.ones(len(xyz), dtype=bool)
+        rest_pos[pos] = False
+        keys = np.empty(len(xyz), dtype=new_keys.dtype)
+        index = np.empty(len(xyz), dtype=np.int32)
+        keys[pos], keys[rest_pos] = new_keys, rest_keys
+        index[pos], index[rest_pos] = new_index, rest_index
+        _sort_stats["avatar_merged"] += len(changed)
+    else:
+        # A new layout, or a re-sort of every segment. Runs whose depth ranges don't overlap
+        # are concatenated in depth order, and only the runs of overlapping groups are
+        # sorted together, which beats NumPy's timsort merging them
+        runs = sorted((cache[segment] for segment in segments if segment[1] > segment[0]), key=lambda entry: entry["keys"][0])
+        groups = []
+        group_max = None
+        for run in runs:
+            if groups and run["keys"][0] <= group_max:
+                groups[-1].append(run)
+                group_max = max(group_max, run["keys"][-1])
+            else:
+                groups.append([run])
+                group_max = run["keys"][-1]
+        keys, index = [np.zeros(0, dtype=np.float32)], [np.zeros(0, dtype=np.int32)]
+        for group in groups:
+            group_keys = np.concatenate([run["keys"] for run in group])
+            group_index = np.concatenate([run["index"] for run in group])
+            if len(group) > 1:
+                order = np.argsort(group_keys)
+                group_keys, group_index = group_keys[order], group_index[order]
+                _sort_stats["avatar_merged"] += len(group)
+            keys.append(group_keys)
+            index.append(group_index)
+        keys, index = np.concatenate(keys), np.concatenate(index)
+    index = index.reshape(-1, 1)
+    _sort_avatar_merged = (segments, keys, index)
+    return index
+
+
+# NumPy releases the GIL while sorting, so the chunks of the parallel sort run on separate cores.
+# PARALLEL_SORT_CHUNKS = 0 uses one chunk per thread
+PARALLEL_SORT_THREADS = os.cpu_count() or 1
+PARALLEL_SORT_CHUNKS = 0
+
+_parallel_sort_executor = None
+
+def set_parallel_sort(n_threads=None, n_chunks=None):
+    global PARALLEL_SORT_THREADS, PARALLEL_SORT_CHUNKS, _parallel_sort_executor
+    if n_threads is not None and n_threads != PARALLEL_SORT_THREADS:
+        PARALLEL_SORT_THREADS = max(1, int(n_threads))
+        if _parallel_sort_executor is not None:
+            _parallel_sort_executor.shutdown()
+            _parallel_sort_executor = None
+    if n_chunks is not None:
+        PARALLEL_SORT_CHUNKS = max(0, int(n_chunks))
+
+def _get_parallel_sort_executor():
+    global _parallel_sort_executor
+    if _parallel_sort_executor is None:
+        _parallel_sort_executor = ThreadPoolExecutor(max_workers=PARALLEL_SORT_THREADS)
+    return _parallel_sort_executor
+
+def _sort_gaussian_parallel(gaus, view_mat):
+    xyz = np.asarray(gaus.xyz)
+    view_mat = np.asarray(view_mat)
+    n = len(xyz)
+    n_chunks = min(PARALLEL_SORT_CHUNKS or PARALLEL_SORT_THREADS, max(1, n))
+    if n_chunks <= 1:
+        return _sort_gaussian_cpu(gaus, view_mat)
+    executor = _get_parallel_sort_executor()
+    bounds = np.linspace(0, n, n_chunks + 1).astype(np.int64)
+
+    # Sort every chunk into a run of (depth, row) pairs
+    def sort_chunk(start, end):
+        depth = xyz[start:end] @ view_mat[2, :3] + view_mat[2, 3]
+        order = np.argsort(depth)
+        return depth[order], order + start
+    runs = list(executor.map(sort_chunk, bounds[:-1], bounds[1:]))
+
+    # k-way merge: depth splitters sampled from the runs cut every run into disjoint depth
+    # intervals, and each interval merges its slices of all runs independently
+    samples = np.sort(np.concatenate([keys[np.linspace(0, len(keys) - 1, n_chunks).astype(np.int64)] for keys, _ in runs]))
+    splitters = samples[np.arange(1, n_chunks) * len(samples) // n_chunks]
+    cuts = np.array([np.concatenate([[0], np.searchsorted(keys, splitters), [len(keys)]]) for keys, _ in runs])
+    part_sizes = np.sum(cuts[:, 1:] - cuts[:, :-1], axis=0)
+    part_starts = np.concatenate([[0], np.cumsum(part_sizes)])
+
+    index = np.empty(n, dtype=np.int32)
+    def merge_part(part):
+        keys = np.concatenate([run[0][cut[part]:cut[part + 1]] for run, cut in zip(runs, cuts)])
+        rows = np.concatenate([run[1][cut[part]:cut[part + 1]] for run, cut in zip(runs, cuts)])
+        # NumPy's stable sort is a timsort, which merges the already sorted runs
+        index[part_starts[part]:part_starts[part + 1]] = rows[np.argsort(keys, kind='stable')]
+    list(executor.map(merge_part, range(n_chunks)))
+    return index.reshape(-1, 1)
+
+
+def _cupy_available():
+    try:
+        import cupy as cp
+        return cp.cuda.runtime.getDeviceCount() > 0
+    except Exception:
+        return False
+
+def _torch_available():
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except Exception:
+        return False
+
+# name -> sort function, for the backends that can run on this machine
+_sort_backends = {}
+# Backends that give the exact order without keeping state between sorts, which makes
+# them safe to time and pick automatically
+_sort_backends_calibrated = []
+
+# Backends that only look at the positions they are given and can sort just the visible subset;
+# the others keep per-row state and sort the whole scene before the culled rows are dropped
+_sort_backends_subset = []
+
+def register_sort_backend(name, sort, calibrate=False, subset=False):
+    _sort_backends[name] = sort
+    if calibrate and name not in _sort_backends_calibrated:
+        _sort_backends_calibrated.append(name)
+    if subset and name not in _sort_backends_subset:
+        _sort_backends_subset.append(name)
+
+def get_sort_backends():
+    return list(_sort_backends)
+
+def calibrate_sort_backends(gaus, view_mat, repeats=2):
+    timings = {}
+    for name in _sort_backends_calibrated:
+        sort = _sort_backends[name]
+        try:
+            # Warm up first, so thread pools and GPU copies of the scene are not timed
+            sort(gaus, view_mat)
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                sort(gaus, view_mat)
+                times.append(time.perf_counter() - start)
+            timings[name] = min(times)
+        except Exception as e:
+            print(f"Sort backend {name} failed during calibration: {e}")
+    fastest = min(timings, key=timings.get) if timings else "full"
+    return fastest, timings
+
+register_sort_backend("full", _sort_gaussian_cpu, calibrate=True, subset=True)
+register_sort_backend("parallel", _sort_gaussian_parallel, calibrate=True, subset=True)
+register_sort_backend("incremental", _sort_gaussian_incremental)
+register_sort_backend("radix16", partial(_sort_gaussian_radix, bits=16), subset=True)
+register_sort_backend("radix32", partial(_sort_gaussian_radix, bits=32), subset=True)
+register_sort_backend("strand", _sort_gaussian_strand)
+register_sort_backend("avatar", _sort_gaussian_avatar)
+if _cupy_available():
+    register_sort_backend("cupy", _sort_gaussian_cupy, calibrate=True)
+if _torch_available():
+    register_sort_backend("torch", _sort_gaussian_torch, calibrate=True)
+
+
+GAUSSIAN_ATTRIBUTES = ("xyz", "rot", "scale", "opacity", "sh")
+
+def _merge_ranges(ranges, n):
+    # sorted, non-overlapping (start, end) ranges clipped to [0, n)
+    merged = []
+    for start, end in sorted((max(0, start), min(n, end)) for start, end in ranges):
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+# Splats are drawn out to 3 standard deviations around their centers
+FRUSTUM_CULL_SIGMA = 3.
+
+# The SH buffer is packed in blocks of SH_BLOCK_ROWS rows (same as in gau_vert.glsl), each
+# keeping only the coefficients up to the lowest SH degree that holds all its nonzero ones
+SH_BLOCK_ROWS = 1024
+SH_DEGREE_DIMS = (3, 12, 27, 48)
+
+def _sh_block_dims(sh, max_dim=None):
+    n, sh_dim = sh.shape
+    sh_dim = min(sh_dim, max_dim or sh_dim)
+    sh = sh[:, :sh_dim]
+    n_full = n // SH_BLOCK_ROWS * SH_BLOCK_ROWS
+    nonzero = np.zeros((-(-n // SH_BLOCK_ROWS), sh_dim), dtype=bool)
+    nonzero[:n_full // SH_BLOCK_ROWS] = np.any(sh[:n_full].reshape(-1, SH_BLOCK_ROWS, sh_dim) != 0, axis=1)
+    if n_full < n:
+        nonzero[-1] = np.any(sh[n_full:] != 0, axis=0)
+    # number of leading coefficients up to the last nonzero one
+    used = np.where(np.any(nonzero, axis=1), sh_dim - np.argmax(nonzero[:, ::-1], axis=1), 0)
+    dims = np.array([dim for dim in SH_DEGREE_DIMS if dim < sh_dim] + [sh_dim])
+    return dims[np.searchsorted(dims, used)]
+
+def _frustum_visible(xyz, radius, view_mat, proj_mat):
+    clip_mat = np.asarray(proj_mat, dtype=np.float64) @ np.asarray(view_mat, dtype=np.float64)
+    planes = np.stack([
+        clip_mat[3] + clip_mat[0], clip_mat[3] - clip_mat[0],  # left, right
+        clip_mat[3] + clip_mat[1], clip_mat[3] - clip_mat[1],  # bottom, top
+        clip_mat[3] + clip_mat[2], clip_mat[3] - clip_mat[2],  # near, far
+    ])
+    planes /= np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+    visible = np.ones(len(xyz), dtype=bool)
+    for plane in planes.astype(np.float32):
+        visible &= xyz @ plane[:3] + plane[3] >= -radius
+    return visible
+
+def _cull_and_sort(sort_backend, gaus, view_mat, proj_mat=None, radius=None, visible=None):
+    # visible masks out the rows that are never drawn (zero opacity, sliced off), and only
+    # the remaining ones are tested against the frustum
+    sort = _sort_backends[sort_backend]
+    xyz = np.asarray(gaus.xyz)
+    rows = None if visible is None else np.flatnonzero(visible)
+    if proj_mat is not None and radius is not None:
+        if rows is None:
+            rows = np.flatnonzero(_frustum_visible(xyz, radius, view_mat, proj_mat))
+        else:
+            rows = rows[_frustum_visible(xyz[rows], radius[rows], view_mat, proj_mat)]
+    if rows is None or len(rows) == len(xyz):
+        _sort_stats["visible"] = len(xyz)
+        return sort(gaus, view_mat)
+    _sort_stats["visible"] = len(rows)
+    if sort_backend in _sort_backends_subset:
+        index = sort(util_gau.GaussianData(xyz[rows], None, None, None, None), view_mat)
+        return rows.astype(np.int32)[index[:, 0]].reshape(-1, 1)
+    index = sort(gaus, view_mat)
+    keep = np.zeros(len(xyz), dtype=bool)
+    keep[rows] = True
+    return index[keep[index[:, 0]]]
 
 
 class GaussianRenderBase:
     def __init__(self):
         self.gaussians = None
+        self.scene_version = 0
+        self.sort_backend = "full"
+        self.background_sort = False
+        self.frustum_culling = True
+        self.scale_modifier = 1.
+        self._cull_radius = None
+        # rows with nonzero opacity, and those of them not cut by the slicing planes
+        self._opacity_visible = None
+        self._visible = None
+        self._dirty_ranges = None
+        self._uploaded_n = 0
+        self._uploaded_sh_dim = 0
+        self._sort_gaussians = None
+        # background sorts and sort backend calibrations run one at a time on this thread
+        self._sort_executor = ThreadPoolExecutor(max_workers=1)
+        self.upload_bytes = 0
+        # half float and 8 bit encoding of the geometry and SH buffers, see GaussianData.compact_geometry
+        self.compact_layout = False
+        self._encoded = {}
+        # SH dimension and word offset of every block of the SH buffer
+        self._sh_dims = None
+        self._sh_offsets = None
+        # SH coefficients the shading mode evaluates, the GPU buffer holds no more than these
+        self._sh_mode_dim = None
+        self._slice = {"selected": -1, "start": 0, "n": 0, "planes": [0., 0., 0.], "inverts": [False, False, False]}
         self._reduce_updates = True
 
     @property
@@ -99,11 +609,169 @@ class GaussianRenderBase:
     def sort_and_update(self):
         raise NotImplementedError()
 
+    def set_sort_backend(self, sort_backend):
+        if sort_backend not in _sort_backends:
+            raise ValueError(f"Unknown sort backend: {sort_backend}")
+        self.sort_backend = sort_backend
+
+    def submit_sort_calibration(self, view_mat):
+        # future of (fastest backend, {backend: seconds}) on the current scene
+        return self._sort_executor.submit(calibrate_sort_backends, self._sort_gaussians, view_mat)
+
+    def buffer_nbytes(self):
+        # bytes of GPU storage held by the buffers of the scene
+        buffers = [getattr(self, name, None) for name in ("gau_buffer", "index_buffer", "opacity_buffer", "sh_buffer", "sh_block_buffer")]
+        return sum(buffer.allocated_nbytes() for buffer in buffers if buffer is not None)
+
+    def _update_cull_radius(self, gaus, dirty=None):
+        if gaus.scale is None or not len(gaus.scale):
+            self._cull_radius = None
+        elif dirty is None or self._cull_radius is None or len(self._cull_radius) != len(gaus):
+            self._cull_radius = FRUSTUM_CULL_SIGMA * np.max(gaus.scale, axis=1)
+        elif dirty.get("scale"):
+            # a new array, as the background sort may still be reading the old one
+            cull_radius = self._cull_radius.copy()
+            for start, end in dirty["scale"]:
+                cull_radius[start:end] = FRUSTUM_CULL_SIGMA * np.max(gaus.scale[start:end], axis=1)
+            self._cull_radius = cull_radius
+
+    def _sort(self, view_mat, proj_mat, visible=None):
+        if not self.frustum_culling or self._cull_radius is None:
+            proj_mat = None
+        radius = None if proj_mat is None else self._cull_radius * self.scale_modifier
+        return _cull_and_sort(self.sort_backend, self._sort_gaussians, view_mat, proj_mat, radius, visible)
+
+    def mark_dirty(self, start, end, *attrs):
+        # Rows whose attributes (all of them if none are named) change before the next
+        # update_gaussian_data. An update without any marked rows treats the whole scene as new
+        if self._dirty_ranges is None:
+            self._dirty_ranges = {}
+        for attr in attrs or GAUSSIAN_ATTRIBUTES:
+            self._dirty_ranges.setdefault(attr, []).append((int(start), int(end)))
+
+    def _take_dirty_ranges(self, gaus):
+        # {attribute: merged row ranges} changed since the last update, or None if everything has to be redone
+        dirty = self._dirty_ranges
+        self._dirty_ranges = None
+        if dirty is None or gaus is not self.gaussians or len(gaus) != self._uploaded_n or gaus.sh_dim != self._uploaded_sh_dim:
+            _mark_avatar_sort_dirty(None)
+            return None
+        dirty = {attr: _merge_ranges(ranges, len(gaus)) for attr, ranges in dirty.items()}
+        # the avatar sort only re-sorts the avatars whose positions changed
+        _mark_avatar_sort_dirty(dirty.get("xyz", []))
+        return dirty
+
+    def _update_visible(self, gaus, dirty=None):
+        opacity = gaus.opacity[:, 0]
+        if dirty is None or self._opacity_visible is None or len(self._opacity_visible) != len(gaus):
+            self._opacity_visible = opacity > 0
+        elif dirty.get("opacity"):
+            opacity_visible = self._opacity_visible.copy()
+            for start, end in dirty["opacity"]:
+                opacity_visible[start:end] = opacity[start:end] > 0
+            self._opacity_visible = opacity_visible
+        self._update_slice_visible()
+
+    def _upload_gaussian_data(self, gaus, dirty=None):
+        # geometry, opacity and SH have buffers of their own, and each uploads only its dirty rows
+        self.upload_bytes = 0
+        compact = self.compact_layout
+        if self.sh_buffer is not None:
+            self._upload_sh(gaus, dirty)
+        for buffer, attrs, rows, encoded in [
+            (self.gau_buffer, ("xyz", "rot", "scale"), gaus.compact_geometry if compact else gaus.flat_geometry, compact),
+            (self.opacity_buffer, ("opacity",), gaus.flat_opacity, False),
+        ]:
+            if dirty is None:
+                data = rows()
+                # encoded rows are kept, so that later updates only re-encode the dirty ones
+                self._encoded[attrs] = data if encoded else None
+                self.upload_bytes += buffer.upload(data)
+                continue
+            ranges = _merge_ranges([r for attr in attrs for r in dirty.get(attr, [])], len(gaus))
+            if not ranges:
+                continue
+            if encoded:
+                data = self._encoded[attrs]
+                for start, end in ranges:
+                    data[start:end] = rows(start, end)
+            else:
+                data = rows()
+            row_bytes = data.itemsize * data.shape[1]
+            self.upload_bytes += buffer.update(data, [(start * row_bytes, end * row_bytes) for start, end in ranges])
+
+    def _sh_block_rows(self, gaus, block, start, end):
+        # rows [start, end) of the block, flattened in the layout of the SH buffer
+        sh_dim = self._sh_dims[block]
+        rows = gaus.compact_sh(start, end, sh_dim) if self.compact_layout else gaus.flat_sh(start, end, sh_dim)
+        return rows.reshape(-1), rows.shape[1]
+
+    def _upload_sh(self, gaus, dirty=None):
+        n = len(gaus)
+        ranges = None if dirty is None else dirty.get("sh", [])
+        if ranges is not None and not ranges:
+            # no SH row and so no block changed, and an empty update would still take the next slot of the ring
+            return
+        if ranges:
+            blocks = sorted({block for start, end in ranges for block in range(start // SH_BLOCK_ROWS, -(-end // SH_BLOCK_ROWS))})
+            dims = {block: _sh_block_dims(gaus.sh[block * SH_BLOCK_ROWS:(block + 1) * SH_BLOCK_ROWS], self._sh_mode_dim)[0] for block in blocks}
+            if any(dims[block] != self._sh_dims[block] for block in blocks):
+                # a block changed its SH degree, so the following blocks move
+                ranges = None
+        if ranges is None:
+            self._sh_dims = _sh_block_dims(gaus.sh, self._sh_mode_dim)
+            parts = [self._sh_block_rows(gaus, block, start, min(start + SH_BLOCK_ROWS, n))[0] for block, start in enumerate(range(0, n, SH_BLOCK_ROWS))]
+            self._sh_offsets = np.cumsum([0] + [len(part) for part in parts[:-1]])
+            self._encoded["sh"] = np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+            table = np.stack([self._sh_offsets, self._sh_dims], axis=1).astype(np.int32) if parts else np.zeros((1, 2), dtype=np.int32)
+            self.upload_bytes += self.sh_buffer.upload(self._encoded["sh"]) + self.sh_block_buffer.upload(table)
+            return
+        data = self._encoded["sh"]
+        byte_ranges = []
+        for start, end in ranges:
+            for block in range(start // SH_BLOCK_ROWS, -(-end // SH_BLOCK_ROWS)):
+                block_start = block * SH_BLOCK_ROWS
+                row_start, row_end = max(start, block_start), min(end, block_start + SH_BLOCK_ROWS)
+                rows, row_dim = self._sh_block_rows(gaus, block, row_start, row_end)
+                offset = self._sh_offsets[block] + (row_start - block_start) * row_dim
+                data[offset:offset + len(rows)] = rows.view(data.dtype)
+                byte_ranges.append((offset * data.itemsize, (offset + len(rows)) * data.itemsize))
+        self.upload_bytes += self.sh_buffer.update(data, byte_ranges)
+
+    def _update_slice_visible(self):
+        # same test as the slicing planes in the vertex shader
+        visible = self._opacity_visible
+        start = self._slice["start"]
+        end = min(start + self._slice["n"], len(visible))
+        if self._slice["selected"] > -1 and start < end:
+            visible = visible.copy()
+            xyz = self.gaussians.xyz[start:end]
+            for axis in range(3):
+                plane = np.float32(self._slice["planes"][axis])
+                if self._slice["inverts"][axis]:
+                    visible[start:end] &= xyz[:, axis] > plane
+                else:
+                    visible[start:end] &= xyz[:, axis] < plane
+        self._visible = visible
+
+    def _set_slice(self, key, value, axis=None):
+        if axis is None:
+            self._slice[key] = value
+        else:
+            self._slice[key][axis] = value
+        if self._opacity_visible is not None and len(self._opacity_visible) == len(self.gaussians):
+            self._update_slice_visible()
+            # the drawn set changed, so the scene has to be sorted again
+            self.scene_version += 1
+
     def set_scale_modifier(self, modifier: float):
         raise NotImplementedError()
     
     def set_render_mod(self, mod: int):
         raise NotImplementedError()
+
+    def set_compact_layout(self, compact):
+        raise NotImplementedError()
     
     def update_camera_pose(self, camera: util.Camera):
         raise NotImplementedError()
@@ -191,8 +859,23 @@ class OpenGLRenderer(GaussianRenderBase):
         vao, buffer_id = util.set_attributes(self.program, ["position"], [self.quad_v])
         util.set_faces_tovao(vao, self.quad_f)
         self.vao = vao
-        self.gau_bufferid = None
-        self.index_bufferid = None
+        # the sorted index is streamed every sort, so the previous one can still be
+        # drawn while the background sort result is uploaded. Its length follows the
+        # culling, so it leaves room to grow and shrinks late, while the Gaussian buffers
+        # are sized exactly
+        self.gau_buffer = util.StreamingBuffer(bind_idx=0)
+        self.index_buffer = util.StreamingBuffer(bind_idx=1, headroom=1.5, shrink=0.25)
+        self.opacity_buffer = util.StreamingBuffer(bind_idx=2)
+        self.sh_buffer = util.StreamingBuffer(bind_idx=3)
+        self.sh_block_buffer = util.StreamingBuffer(bind_idx=4)
+        self.index_count = 0
+        self.background_sort = True
+        self._sort_future = None
+        self._sort_future_n = 0
+        self._pending_view = None
+        self._last_view = None
+        # number of Gaussians the drawn index was sorted for
+        self.sorted_n = 0
         # opengl settings
         gl.glDisable(gl.GL_CULL_FACE)
         gl.glEnable(gl.GL_BLEND)
@@ -208,26 +891,83 @@ class OpenGLRenderer(GaussianRenderBase):
             print("VSync is not supported")
 
     def update_gaussian_data(self, gaus: util_gau.GaussianData):
+        dirty = self._take_dirty_ranges(gaus)
         self.gaussians = gaus
+        self._uploaded_n = len(gaus)
+        self._uploaded_sh_dim = gaus.sh_dim
+        # a new object per update, as the GPU sort backends keep the positions of the object they last saw
+        self._sort_gaussians = dataclasses.replace(gaus)
+        self.scene_version += 1
+        self._update_cull_radius(gaus, dirty)
+        self._update_visible(gaus, dirty)
         # load gaussian geometry
-        gaussian_data = gaus.flat()
-        self.gau_bufferid = util.set_storage_buffer_data(self.program, "gaussian_data", gaussian_data,
-                                                         bind_idx=0,
-                                                         buffer_id=self.gau_bufferid)
+        self._upload_gaussian_data(gaus, dirty)
         util.set_uniform_1int(self.program, gaus.sh_dim, "sh_dim")
 
+        # the drawn indices must never point past the new data
+        if self._last_view is not None and len(gaus) != self.sorted_n:
+            self._sort_now(*self._last_view)
+
     def sort_and_update(self, camera: util.Camera):
-        index = _sort_gaussian(self.gaussians, camera.get_view_matrix())
-        self.index_bufferid = util.set_storage_buffer_data(self.program, "gi", index,
-                                                           bind_idx=1,
-                                                           buffer_id=self.index_bufferid)
-        return
+        # the view and projection matrices are sorted and culled against together
+        view = (camera.get_view_matrix(), camera.get_project_matrix())
+        self._last_view = view
+        if not self.background_sort or len(self.gaussians) != self.sorted_n:
+            self._sort_now(*view)
+        elif self._sort_future is not None:
+            # only the newest view is sorted once the running sort is done
+            self._pending_view = view
+        else:
+            self._submit_sort(view)
+
+    def _submit_sort(self, view):
+        self._sort_future = self._sort_executor.submit(self._sort, *view, self._visible)
+        self._sort_future_n = len(self.gaussians)
+
+    def _sort_now(self, view_mat, proj_mat):
+        if self._sort_future is not None:
+            self._sort_future.result()
+            self._sort_future = None
+        self._pending_view = None
+        index = self._sort(view_mat, proj_mat, self._visible)
+        self._upload_index(index, len(self.gaussians))
+
+    def _collect_sort(self):
+        if self._sort_future is None or not self._sort_future.done():
+            return
+        index = self._sort_future.result()
+        self._sort_future = None
+        # results computed for data that has since been resized are dropped
+        if self._sort_future_n == len(self.gaussians):
+            self._upload_index(index, self._sort_future_n)
+        if self._pending_view is not None:
+            self._submit_sort(self._pending_view)
+            self._pending_view = None
+
+    def _upload_index(self, index, sorted_n):
+        self.index_buffer.upload(index)
+        self.index_count = len(index)
+        self.sorted_n = sorted_n
    
     def set_scale_modifier(self, modifier):
+        self.scale_modifier = modifier
         util.set_uniform_1f(self.program, modifier, "scale_modifier")
 
     def set_render_mod(self, mod: int):
         util.set_uniform_1int(self.program, mod, "render_mod")
+        # modes below SH:0~1 only read the DC color
+        sh_mode_dim = SH_DEGREE_DIMS[min(max(mod, 0), 3)]
+        if sh_mode_dim != self._sh_mode_dim:
+            self._sh_mode_dim = sh_mode_dim
+            if self.gaussians is not None:
+                self.upload_bytes = 0
+                self._upload_sh(self.gaussians)
+
+    def set_compact_layout(self, compact):
+        self.compact_layout = compact
+        util.set_uniform_1int(self.program, int(compact), "compact_layout")
+        if self.gaussians is not None:
+            self._upload_gaussian_data(self.gaussians)
 
     def set_render_reso(self, w, h):
         gl.glViewport(0, 0, w, h)
@@ -244,9 +984,11 @@ class OpenGLRenderer(GaussianRenderBase):
 
     def update_start(self, start):
         util.set_uniform_1int(self.program, start, "start_index")
+        self._set_slice("start", start)
 
     def update_n_gaussians(self, n_gaussians):
         util.set_uniform_1int(self.program, n_gaussians, "n_gaussians")
+        self._set_slice("n", n_gaussians)
 
     def update_n_hair_gaussians(self, n_hair_gaussians):
         util.set_uniform_1int(self.program, n_hair_gaussians, "n_hair_gaussians")
@@ -268,27 +1010,34 @@ class OpenGLRenderer(GaussianRenderBase):
 
     def update_invert_x_plane(self, invert_x_plane):
         util.set_uniform_1int(self.program, int(invert_x_plane), "invert_x_plane")
+        self._set_slice("inverts", bool(invert_x_plane), 0)
 
     def update_invert_y_plane(self, invert_y_plane):
         util.set_uniform_1int(self.program, int(invert_y_plane), "invert_y_plane")
+        self._set_slice("inverts", bool(invert_y_plane), 1)
     
     def update_invert_z_plane(self, invert_z_plane):
         util.set_uniform_1int(self.program, int(invert_z_plane), "invert_z_plane")
+        self._set_slice("inverts", bool(invert_z_plane), 2)
 
     def update_selected_head_avatar_index(self, selected_head_avatar_index):
         util.set_uniform_1int(self.program, selected_head_avatar_index, "selected_head_avatar_index")
+        self._set_slice("selected", selected_head_avatar_index)
 
     def update_max_cutting_distance(self, max_cutting_distance):
         util.set_uniform_1f(self.program, max_cutting_distance, "max_cutting_distance")
 
     def update_x_plane(self, x_plane):
         util.set_uniform_1f(self.program, x_plane, "x_plane")
+        self._set_slice("planes", x_plane, 0)
 
     def update_y_plane(self, y_plane):
         util.set_uniform_1f(self.program, y_plane, "y_plane")
+        self._set_slice("planes", y_plane, 1)
 
     def update_z_plane(self, z_plane):
         util.set_uniform_1f(self.program, z_plane, "z_plane")
+        self._set_slice("planes", z_plane, 2)
 
     def update_ray_direction(self, camera: util.Camera, mouse_pos_2d):
         mouse_pos_3d = util.glhUnProjectf(mouse_pos_2d.x, mouse_pos_2d.y, 1, camera.get_view_matrix(), camera.get_project_matrix(), gl.glGetIntegerv(gl.GL_VIEWPORT))
@@ -297,11 +1046,16 @@ class OpenGLRenderer(GaussianRenderBase):
         util.set_uniform_v3(self.program, ray_direction, "ray_direction")
    
     def draw(self):
+        self._collect_sort()
         gl.glUseProgram(self.program)
         gl.glBindVertexArray(self.vao)
-        num_gau = len(self.gaussians)
+        for buffer in [self.gau_buffer, self.index_buffer, self.opacity_buffer, self.sh_buffer, self.sh_block_buffer]:
+            buffer.bind()
+        num_gau = self.index_count
         # an instance renders 2 TRIANGLES, by rendering 6 different points, done as many times as number of gaussians
         gl.glDrawElementsInstanced(gl.GL_TRIANGLES, len(self.quad_f.reshape(-1)), gl.GL_UNSIGNED_INT, None, num_gau)
+        for buffer in [self.gau_buffer, self.index_buffer, self.opacity_buffer, self.sh_buffer, self.sh_block_buffer]:
+            buffer.fence()
 
 class OpenGLRendererAxes(GaussianRenderBase):
     def __init__(self, w, h):
@@ -322,8 +1076,12 @@ class OpenGLRendererAxes(GaussianRenderBase):
         # load quad geometry
         vao, buffer_id = util.set_attributes(self.program, ["lines"], [self.lines])
         self.vao = vao
-        self.gau_bufferid = None
-        self.index_bufferid = None
+        self.gau_buffer = util.StreamingBuffer(bind_idx=0)
+        self.index_buffer = util.StreamingBuffer(bind_idx=1)
+        self.opacity_buffer = util.StreamingBuffer(bind_idx=2)
+        # the axes are drawn without colors
+        self.sh_buffer = None
+        self.index_count = 0
         # opengl settings
         gl.glDisable(gl.GL_CULL_FACE)
         gl.glEnable(gl.GL_BLEND)
@@ -336,27 +1094,39 @@ class OpenGLRendererAxes(GaussianRenderBase):
             wglSwapIntervalEXT(1 if self.reduce_updates else 0)
 
     def update_gaussian_data(self, gaus: util_gau.GaussianData):
+        dirty = self._take_dirty_ranges(gaus)
         self.gaussians = gaus
+        self._uploaded_n = len(gaus)
+        self._uploaded_sh_dim = gaus.sh_dim
+        # a new object per update, as the GPU sort backends keep the positions of the object they last saw
+        self._sort_gaussians = dataclasses.replace(gaus)
+        self.scene_version += 1
+        self._update_cull_radius(gaus, dirty)
+        self._update_visible(gaus, dirty)
         # load gaussian geometry
-        gaussian_data = gaus.flat()
-        self.gau_bufferid = util.set_storage_buffer_data(self.program, "gaussian_data", gaussian_data,
-                                                         bind_idx=0,
-                                                         buffer_id=self.gau_bufferid)
+        self._upload_gaussian_data(gaus, dirty)
         util.set_uniform_1int(self.program, gaus.sh_dim, "sh_dim")
 
     def sort_and_update(self, camera: util.Camera):
-        index = _sort_gaussian(self.gaussians, camera.get_view_matrix())
-        self.index_bufferid = util.set_storage_buffer_data(self.program, "gi", index,
-                                                           bind_idx=1,
-                                                           buffer_id=self.index_bufferid)
+        # the axes shader hides zero opacity Gaussians but does not slice
+        index = self._sort(camera.get_view_matrix(), camera.get_project_matrix(), self._opacity_visible)
+        self.index_buffer.upload(index)
+        self.index_count = len(index)
         return
    
     def set_scale_modifier(self, modifier):
+        self.scale_modifier = modifier
         util.set_uniform_1f(self.program, modifier, "scale_modifier")
 
     def set_render_mod(self, mod: int):
         util.set_uniform_1int(self.program, mod, "render_mod")
 
+    def set_compact_layout(self, compact):
+        self.compact_layout = compact
+        util.set_uniform_1int(self.program, int(compact), "compact_layout")
+        if self.gaussians is not None:
+            self._upload_gaussian_data(self.gaussians)
+
     def set_render_reso(self, w, h):
         gl.glViewport(0, 0, w, h)
 
@@ -427,5 +1197,9 @@ class OpenGLRendererAxes(GaussianRenderBase):
     def draw(self):
         gl.glUseProgram(self.program)
         gl.glBindVertexArray(self.vao)
-        num_gau = len(self.gaussians)
+        for buffer in [self.gau_buffer, self.index_buffer, self.opacity_buffer]:
+            buffer.bind()
+        num_gau = min(self.index_count, len(self.gaussians))
         gl.glDrawArraysInstanced(gl.GL_LINES, 0, len(self.lines.reshape(-1)), num_gau)
+        for buffer in [self.gau_buffer, self.index_buffer, self.opacity_buffer]:
+            buffer.fence()
@@ -28,27 +28,42 @@ layout(location = 0) in vec2 position;
 #define POS_IDX 0
 #define ROT_IDX 3
 #define SCALE_IDX 7
-#define OPACITY_IDX 10
-#define SH_IDX 11
+#define GEOMETRY_DIM 10
+// rows of GaussianData.compact_geometry: float xyz, then rot and log scale as half floats
+#define COMPACT_ROT_IDX 3
+#define COMPACT_SCALE_IDX 5
+#define COMPACT_GEOMETRY_DIM 7
 
+// geometry, opacity and SH are kept in separate buffers, so animating the geometry
+// does not re-upload the colors
 layout (std430, binding=0) buffer gaussian_data {
 	float g_data[];
 	// compact version of following data
 	// vec3 g_pos[];
 	// vec4 g_rot[];
 	// vec3 g_scale[];
-	// float g_opacity[];
-	// vec3 g_sh[];
 };
 layout (std430, binding=1) buffer gaussian_order {
 	int gi[];
 };
+layout (std430, binding=2) buffer gaussian_opacity {
+	float g_opacity_data[];
+};
+layout (std430, binding=3) buffer gaussian_sh {
+	float g_sh[];
+};
+// the SH rows are packed in blocks of SH_BLOCK_ROWS, each with its own number of coefficients
+#define SH_BLOCK_ROWS 1024
+layout (std430, binding=4) buffer gaussian_sh_blocks {
+	ivec2 g_sh_blocks[];  // word offset and sh_dim of every block
+};
 
 uniform mat4 view_matrix;
 uniform mat4 projection_matrix;
 uniform vec3 hfovxy_focal;
 uniform vec3 cam_pos;
 uniform int sh_dim;
+uniform int compact_layout;
 uniform float scale_modifier;
 uniform int render_mod;  // > 0 render 0-ith SH dim, -1 depth, -2 bill board, -3 gaussian
 
@@ -132,12 +147,31 @@ vec4 get_vec4(int offset)
 {
 	return vec4(g_data[offset], g_data[offset + 1], g_data[offset + 2], g_data[offset + 3]);
 }
+vec2 get_half2(int offset)
+{
+	return unpackHalf2x16(floatBitsToUint(g_data[offset]));
+}
+// rows of GaussianData.compact_sh: half float DC color, minimum and range, then the
+// remaining coefficients as 8 bit steps of that range
+float get_sh_coef(int sh_start, int i)
+{
+	if (compact_layout == 0)
+		return g_sh[sh_start + i];
+	if (i < 3)
+		return unpackHalf2x16(floatBitsToUint(g_sh[sh_start + i / 2]))[i % 2];
+	float low = unpackHalf2x16(floatBitsToUint(g_sh[sh_start + 1])).y;
+	float extent = unpackHalf2x16(floatBitsToUint(g_sh[sh_start + 2])).x;
+	return low + extent * unpackUnorm4x8(floatBitsToUint(g_sh[sh_start + 3 + (i - 3) / 4]))[(i - 3) % 4];
+}
+vec3 get_sh(int sh_start, int i)
+{
+	return vec3(get_sh_coef(sh_start, i), get_sh_coef(sh_start, i + 1), get_sh_coef(sh_start, i + 2));
+}
 
 void main()
 {
 	int boxid = gi[gl_InstanceID];
-	int total_dim = 3 + 4 + 3 + 1 + sh_dim;
-	int start = boxid * total_dim;
+	int start = boxid * (compact_layout == 1 ? COMPACT_GEOMETRY_DIM : GEOMETRY_DIM);
 	vec4 g_pos = vec4(get_vec3(start + POS_IDX), 1.f);
     vec4 g_pos_view = view_matrix * g_pos;
     vec4 g_pos_screen = projection_matrix * g_pos_view;
@@ -149,9 +183,19 @@ void main()
 		gl_Position = vec4(-100, -100, -100, 1);
 		return;
 	}
-	vec4 g_rot = get_vec4(start + ROT_IDX);
-	vec3 g_scale = get_vec3(start + SCALE_IDX);
-	float g_opacity = g_data[start + OPACITY_IDX];
+	vec4 g_rot;
+	vec3 g_scale;
+	if (compact_layout == 1)
+	{
+		g_rot = vec4(get_half2(start + COMPACT_ROT_IDX), get_half2(start + COMPACT_ROT_IDX + 1));
+		g_scale = exp(vec3(get_half2(start + COMPACT_SCALE_IDX), get_half2(start + COMPACT_SCALE_IDX + 1).x));
+	}
+	else
+	{
+		g_rot = get_vec4(start + ROT_IDX);
+		g_scale = get_vec3(start + SCALE_IDX);
+	}
+	float g_opacity = g_opacity_data[boxid];
 
     mat3 cov3d = computeCov3D(g_scale * scale_modifier, g_rot);
     vec2 wh = 2 * hfovxy_focal.xy * hfovxy_focal.z;
@@ -215,10 +259,13 @@ void main()
 	}
 
 	// Covert SH to color
-	int sh_start = start + SH_IDX;
+	ivec2 sh_block = g_sh_blocks[boxid / SH_BLOCK_ROWS];
+	int row_sh_dim = sh_block.y;
+	int sh_row_dim = compact_layout == 1 ? (row_sh_dim > 3 ? 3 + row_sh_dim / 4 : 2) : row_sh_dim;
+	int sh_start = sh_block.x + boxid % SH_BLOCK_ROWS * sh_row_dim;
 	vec3 dir = g_pos.xyz - cam_pos;
     dir = normalize(dir);
-	color = SH_C0 * get_vec3(sh_start);
+	color = SH_C0 * get_sh(sh_start, 0);
 
 	if (coloring_mode == 1 && alpha != 0 && selected_head_avatar_index > -1 && boxid >= start_index && boxid < start_index + n_gaussians) {
 		float projection = dot(ray_direction, g_pos.xyz-cam_pos);
@@ -227,34 +274,34 @@ void main()
 		color = distance < max_coloring_distance ? SH_C0 * selected_color : color;
 	}
 	
-	if (sh_dim > 3 && render_mod >= 1)  // 1 * 3
+	if (row_sh_dim > 3 && render_mod >= 1)  // 1 * 3
 	{
 		float x = dir.x;
 		float y = dir.y;
 		float z = dir.z;
-		color = color - SH_C1 * y * get_vec3(sh_start + 1 * 3) + SH_C1 * z * get_vec3(sh_start + 2 * 3) - SH_C1 * x * get_vec3(sh_start + 3 * 3);
+		color = color - SH_C1 * y * get_sh(sh_start, 1 * 3) + SH_C1 * z * get_sh(sh_start, 2 * 3) - SH_C1 * x * get_sh(sh_start, 3 * 3);
 
-		if (sh_dim > 12 && render_mod >= 2)  // (1 + 3) * 3
+		if (row_sh_dim > 12 && render_mod >= 2)  // (1 + 3) * 3
 		{
 			float xx = x * x, yy = y * y, zz = z * z;
 			float xy = x * y, yz = y * z, xz = x * z;
 			color = color +
-				SH_C2_0 * xy * get_vec3(sh_start + 4 * 3) +
-				SH_C2_1 * yz * get_vec3(sh_start + 5 * 3) +
-				SH_C2_2 * (2.0f * zz - xx - yy) * get_vec3(sh_start + 6 * 3) +
-				SH_C2_3 * xz * get_vec3(sh_start + 7 * 3) +
-				SH_C2_4 * (xx - yy) * get_vec3(sh_start + 8 * 3);
+				SH_C2_0 * xy * get_sh(sh_start, 4 * 3) +
+				SH_C2_1 * yz * get_sh(sh_start, 5 * 3) +
+				SH_C2_2 * (2.0f * zz - xx - yy) * get_sh(sh_start, 6 * 3) +
+				SH_C2_3 * xz * get_sh(sh_start, 7 * 3) +
+				SH_C2_4 * (xx - yy) * get_sh(sh_start, 8 * 3);
 
-			if (sh_dim > 27 && render_mod >= 3)  // (1 + 3 + 5) * 3
+			if (row_sh_dim > 27 && render_mod >= 3)  // (1 + 3 + 5) * 3
 			{
 				color = color +
-					SH_C3_0 * y * (3.0f * xx - yy) * get_vec3(sh_start + 9 * 3) +
-					SH_C3_1 * xy * z * get_vec3(sh_start + 10 * 3) +
-					SH_C3_2 * y * (4.0f * zz - xx - yy) * get_vec3(sh_start + 11 * 3) +
-					SH_C3_3 * z * (2.0f * zz - 3.0f * xx - 3.0f * yy) * get_vec3(sh_start + 12 * 3) +
-					SH_C3_4 * x * (4.0f * zz - xx - yy) * get_vec3(sh_start + 13 * 3) +
-					SH_C3_5 * z * (xx - yy) * get_vec3(sh_start + 14 * 3) +
-					SH_C3_6 * x * (xx - 3.0f * yy) * get_vec3(sh_start + 15 * 3);
+					SH_C3_0 * y * (3.0f * xx - yy) * get_sh(sh_start, 9 * 3) +
+					SH_C3_1 * xy * z * get_sh(sh_start, 10 * 3) +
+					SH_C3_2 * y * (4.0f * zz - xx - yy) * get_sh(sh_start, 11 * 3) +
+					SH_C3_3 * z * (2.0f * zz - 3.0f * xx - 3.0f * yy) * get_sh(sh_start, 12 * 3) +
+					SH_C3_4 * x * (4.0f * zz - xx - yy) * get_sh(sh_start, 13 * 3) +
+					SH_C3_5 * z * (xx - yy) * get_sh(sh_start, 14 * 3) +
+					SH_C3_6 * x * (xx - 3.0f * yy) * get_sh(sh_start, 15 * 3);
 			}
 		}
 	}
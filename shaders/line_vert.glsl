@@ -11,26 +11,32 @@ layout(location = 1) in vec3 lines;
 #define POS_IDX 0
 #define ROT_IDX 3
 #define SCALE_IDX 7
-#define OPACITY_IDX 10
-#define SH_IDX 11
+#define GEOMETRY_DIM 10
+// rows of GaussianData.compact_geometry: float xyz, then rot and log scale as half floats
+#define COMPACT_ROT_IDX 3
+#define COMPACT_SCALE_IDX 5
+#define COMPACT_GEOMETRY_DIM 7
 
+// geometry and opacity are kept in separate buffers, the SH colors are not needed here
 layout (std430, binding=0) buffer gaussian_data {
 	float g_data[];
 	// compact version of following data
 	// vec3 g_pos[];
 	// vec4 g_rot[];
 	// vec3 g_scale[];
-	// float g_opacity[];
-	// vec3 g_sh[];
 };
 layout (std430, binding=1) buffer gaussian_order {
 	int gi[];
 };
+layout (std430, binding=2) buffer gaussian_opacity {
+	float g_opacity_data[];
+};
 
 uniform mat4 view_matrix;
 uniform mat4 projection_matrix;
 uniform vec3 cam_pos;
 uniform int sh_dim;
+uniform int compact_layout;
 uniform float scale_modifier;
 uniform int render_mod;
 
@@ -73,26 +79,39 @@ vec4 get_vec4(int offset)
 {
 	return vec4(g_data[offset], g_data[offset + 1], g_data[offset + 2], g_data[offset + 3]);
 }
+vec2 get_half2(int offset)
+{
+	return unpackHalf2x16(floatBitsToUint(g_data[offset]));
+}
 
 void main()
 {
 	int boxid = gi[gl_InstanceID];
-	int total_dim = 3 + 4 + 3 + 1 + sh_dim;
-	int start = boxid * total_dim;
+	int start = boxid * (compact_layout == 1 ? COMPACT_GEOMETRY_DIM : GEOMETRY_DIM);
 	vec4 g_pos = vec4(get_vec3(start + POS_IDX), 1.f);
     vec4 g_pos_view = view_matrix * g_pos;
     vec4 g_pos_screen = projection_matrix * g_pos_view;
 	g_pos_screen.xyz = g_pos_screen.xyz / g_pos_screen.w;
     g_pos_screen.w = 1.f;
-	float g_opacity = g_data[start + OPACITY_IDX];
+	float g_opacity = g_opacity_data[boxid];
 	// early culling
 	if (any(greaterThan(abs(g_pos_screen.xyz), vec3(1.3))) || g_opacity == 0.f)
 	{
 		gl_Position = vec4(-100, -100, -100, 1);
 		return;
 	}
-	vec4 g_rot = get_vec4(start + ROT_IDX);
-	vec3 g_scale = get_vec3(start + SCALE_IDX);
+	vec4 g_rot;
+	vec3 g_scale;
+	if (compact_layout == 1)
+	{
+		g_rot = vec4(get_half2(start + COMPACT_ROT_IDX), get_half2(start + COMPACT_ROT_IDX + 1));
+		g_scale = exp(vec3(get_half2(start + COMPACT_SCALE_IDX), get_half2(start + COMPACT_SCALE_IDX + 1).x));
+	}
+	else
+	{
+		g_rot = get_vec4(start + ROT_IDX);
+		g_scale = get_vec3(start + SCALE_IDX);
+	}
 
 	mat3 M = computeSR(g_scale * scale_modifier, g_rot);
 	vec4 second_point = vec4(lines*M + g_pos.xyz, 1.f);
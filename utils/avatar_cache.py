@@ -0,0 +1,93 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "dynamic_gaussian_visualizer")
+# Part of every key, to be raised whenever the arrays stored for a file change how they are
+# derived from it, so that entries of older versions are misses and age out
+FORMAT_VERSION = 1
+
+class AvatarCache:
+    # Arrays decoded from avatar files, stored as a directory of .npy files per file. Entries
+    # are keyed by the format version and the path, size and modification time of the file,
+    # so any change to it is a miss. Hits are memory mapped, and once the cache grows past
+    # max_bytes the least recently used entries are evicted. A max_bytes of 0 disables the
+    # cache. Loader threads share one cache, so entries are only added, read and evicted
+    # under its lock
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def key(self, path):
+        stat = os.stat(path)
+        key = f"{FORMAT_VERSION}\0{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, path):
+        # {name: read only memmap} cached for the file as it is now, or None
+        if self.max_bytes <= 0:
+            return None
+        entry = os.path.join(self.directory, self.key(path))
+        with self._lock:
+            if not os.path.isdir(entry):
+                return None
+            try:
+                arrays = {name[:-len(".npy")]: np.load(os.path.join(entry, name), mmap_mode="r")
+                          for name in os.listdir(entry) if name.endswith(".npy")}
+                # the modification time of the entry is its last use
+                os.utime(entry)
+            except (OSError, ValueError):
+                return None
+        return arrays
+
+    def put(self, path, arrays):
+        if self.max_bytes <= 0:
+            return
+        entry = os.path.join(self.directory, self.key(path))
+        os.makedirs(self.directory, exist_ok=True)
+        # written under a temporary name, so that a reader never maps half an entry
+        tmp = tempfile.mkdtemp(dir=self.directory, suffix=".tmp")
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + ".npy"), np.asarray(array))
+            with self._lock:
+                os.rename(tmp, entry)
+                self._evict()
+        except OSError:
+            # out of space, or the entry was written by someone else in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def entries(self):
+        # (last use, bytes, directory) of every entry
+        ret = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if name.endswith(".tmp") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+                ret.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+        return ret
+
+    def nbytes(self):
+        return sum(size for _, size, _ in self.entries()) if os.path.isdir(self.directory) else 0
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            # entries still mapped by a loaded avatar stay readable until it is closed
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils import util_gau
+
+def random_avatar(n_gaussians, sh_dim, seed=0):
+    rng = np.random.default_rng(seed)
+    xyz = rng.normal(size=(n_gaussians, 3)).astype(np.float32)
+    rot = rng.normal(size=(n_gaussians, 4)).astype(np.float32)
+    scale = rng.uniform(0, 0.01, size=(n_gaussians, 3)).astype(np.float32)
+    opacity = rng.uniform(size=(n_gaussians, 1)).astype(np.float32)
+    sh = rng.normal(size=(n_gaussians, sh_dim)).astype(np.float32)
+    return util_gau.GaussianData(xyz, rot, scale, opacity, sh)
+
+def time_edit(edit, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        edit()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main(args):
+    separate = random_avatar(args.n_gaussians, args.sh_dim)
+    packed = util_gau.PackedGaussianData.pack(separate)
+    assert np.array_equal(separate.flat(), packed.flat()), "packed rows differ from the separate attributes"
+    n_hair = args.n_gaussians // 2
+
+    # the copies the edit paths in main.py make, before (separate arrays) and after (packed rows)
+    edits = {
+        "hair scale": (lambda gaus: gaus.get_data()[2][:n_hair], lambda gaus: gaus.get_scale(0, n_hair)),
+        "hair color": (lambda gaus: gaus.get_data()[4][:n_hair], lambda gaus: gaus.get_sh(0, n_hair)),
+        "head opacity": (lambda gaus: gaus.get_data()[3][n_hair:], lambda gaus: gaus.get_opacity(n_hair)),
+        "means": (lambda gaus: gaus.get_data()[:3], lambda gaus: (gaus.get_xyz(), gaus.get_rot(), gaus.get_scale())),
+    }
+    for name, (before, after) in edits.items():
+        t_before = time_edit(lambda: before(separate), args.repeats)
+        t_after = time_edit(lambda: after(packed), args.repeats)
+        print(f"{name}: before {t_before * 1000:.2f} ms, after {t_after * 1000:.2f} ms")
+
+    t_get_data = time_edit(separate.get_data, args.repeats)
+    t_get_data_packed = time_edit(packed.get_data, args.repeats)
+    print(f"get_data: separate {t_get_data * 1000:.2f} ms, packed {t_get_data_packed * 1000:.2f} ms")
+    t_flat = time_edit(separate.flat, args.repeats)
+    t_flat_packed = time_edit(packed.flat, args.repeats)
+    print(f"flat: separate {t_flat * 1000:.2f} ms, packed {t_flat_packed * 1000:.3f} ms")
+
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    parser.add_argument('--n_gaussians', default=1000000, type=int)
+    parser.add_argument('--sh_dim', default=48, type=int)
+    parser.add_argument('--repeats', default=5, type=int)
+
+    args, _ = parser.parse_known_args()
+    args = parser.parse_args()
+
+    main(args)
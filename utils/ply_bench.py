@@ -0,0 +1,57 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from plyfile import PlyData, PlyElement
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from utils import util_gau
+
+def write_random_ply(path, n_gaussians, seed=0):
+    # Property order of 3D Gaussian splatting checkpoints, plus the strand constants of exported avatars
+    rng = np.random.default_rng(seed)
+    names = ["x", "y", "z", "nx", "ny", "nz", "f_dc_0", "f_dc_1", "f_dc_2"] + [f"f_rest_{j}" for j in range(45)] + \
+        ["opacity"] + [f"scale_{j}" for j in range(3)] + [f"rot_{j}" for j in range(4)]
+    vertices = np.empty(n_gaussians, dtype=[(name, 'f4') for name in names] + [('n_strands', 'i4'), ('n_gaussians_per_strand', 'i4')])
+    for name in names:
+        vertices[name] = rng.normal(size=n_gaussians)
+    vertices['n_strands'] = n_gaussians // 100
+    vertices['n_gaussians_per_strand'] = 100
+    PlyData([PlyElement.describe(vertices, 'vertex')]).write(path)
+
+def time_load(load, path, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        ret = load(path)
+        times.append(time.perf_counter() - start)
+    return ret, min(times)
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.ply
+        if path is None:
+            path = os.path.join(tmp, "random.ply")
+            write_random_ply(path, args.n_gaussians)
+
+        (gaus, constants), t_plyfile = time_load(util_gau.load_ply_plyfile, path, args.repeats)
+        (fast_gaus, fast_constants), t_fast = time_load(util_gau.load_ply, path, args.repeats)
+        assert np.array_equal(gaus.flat(), fast_gaus.flat()), "the loaders read different Gaussians"
+        assert constants == fast_constants and [type(c) for c in constants] == [type(c) for c in fast_constants], \
+            "the loaders read different head avatar constants"
+        print(f"{len(gaus)} Gaussians: PlyData {t_plyfile * 1000:.0f} ms, memmap {t_fast * 1000:.0f} ms")
+
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    parser.add_argument('--ply', default=None, type=str)
+    parser.add_argument('--n_gaussians', default=1000000, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+
+    args, _ = parser.parse_known_args()
+    args = parser.parse_args()
+
+    main(args)
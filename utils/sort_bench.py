@@ -0,0 +1,123 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from renderers import renderer_ogl
+from utils import util, util_gau
+
+def random_scene(n_gaussians, seed=0):
+    rng = np.random.default_rng(seed)
+    xyz = rng.normal(size=(n_gaussians, 3)).astype(np.float32)
+    return util_gau.GaussianData(xyz, None, None, None, None)
+
+def random_view(seed=0):
+    rng = np.random.default_rng(seed)
+    q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    view_mat = np.eye(4, dtype=np.float32)
+    view_mat[:3, :3] = q
+    view_mat[2, 3] = -3
+    return view_mat
+
+def check_quantized_order(gaus, view_mat, bits):
+    # The quantized order may only swap Gaussians whose depths lie within one quantization step
+    depth = gaus.xyz.astype(np.float64) @ view_mat[2, :3] + view_mat[2, 3]
+    _, step = renderer_ogl._quantize_depth(depth.astype(np.float32), bits)
+    index = renderer_ogl._sort_gaussian_radix(gaus, view_mat, bits=bits)[:, 0]
+    assert np.array_equal(np.sort(index), np.arange(len(gaus))), "index is not a permutation"
+    sorted_depth = depth[index]
+    max_inversion = max(0., -np.min(np.diff(sorted_depth)))
+    # float32 depth rounding adds to the quantization step
+    tolerance = step + 2 * np.finfo(np.float32).eps * np.max(np.abs(depth))
+    assert max_inversion <= tolerance, f"{bits}-bit order inverts depths by {max_inversion} > {tolerance}"
+    return max_inversion, step
+
+def time_backend(backend, gaus, view_mat, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        backend(gaus, view_mat)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def check_exact_order(backend, gaus, view_mat):
+    depth = gaus.xyz @ view_mat[2, :3] + view_mat[2, 3]
+    index = backend(gaus, view_mat)[:, 0]
+    assert np.array_equal(np.sort(index), np.arange(len(gaus))), "index is not a permutation"
+    assert np.all(np.diff(depth[index]) >= 0), "index is not sorted by depth"
+
+def bench_parallel(args):
+    renderer_ogl.set_parallel_sort(args.threads or None, args.chunks)
+    print(f"parallel sort: {renderer_ogl.PARALLEL_SORT_THREADS} threads, {renderer_ogl.PARALLEL_SORT_CHUNKS or renderer_ogl.PARALLEL_SORT_THREADS} chunks")
+    view_mat = random_view()
+    for n_gaussians in args.parallel_sizes:
+        gaus = random_scene(n_gaussians)
+        check_exact_order(renderer_ogl._sort_gaussian_parallel, gaus, view_mat)
+        single = time_backend(renderer_ogl._sort_gaussian_cpu, gaus, view_mat, args.repeats)
+        parallel = time_backend(renderer_ogl._sort_gaussian_parallel, gaus, view_mat, args.repeats)
+        print(f"{n_gaussians:>10}: full {single * 1000:.1f} ms, parallel {parallel * 1000:.1f} ms ({single / parallel:.2f}x)")
+
+def rotate_view(view_mat, angle):
+    # view_mat turned by angle radians about the camera's vertical axis
+    rotation = np.eye(4, dtype=np.float32)
+    rotation[[0, 0, 2, 2], [0, 2, 0, 2]] = np.cos(angle), np.sin(angle), -np.sin(angle), np.cos(angle)
+    return (rotation @ view_mat).astype(np.float32)
+
+def bench_incremental(gaus, view_mat, angles, repeats):
+    # Re-sorts after the camera turned by each angle, from the order of the view before
+    prev_index = renderer_ogl._sort_gaussian_cpu(gaus, view_mat)[:, 0].astype(np.int64)
+    for angle in angles:
+        moved = rotate_view(view_mat, angle)
+        def incremental(gaus, moved_mat):
+            # every repeat starts from the order of the unmoved view
+            renderer_ogl._sort_prev_index, renderer_ogl._sort_prev_view = prev_index, view_mat
+            return renderer_ogl._sort_gaussian_incremental(gaus, moved_mat)
+        def from_scratch(gaus, moved_mat):
+            renderer_ogl._sort_prev_index = None
+            return renderer_ogl._sort_gaussian_incremental(gaus, moved_mat)
+        repaired = renderer_ogl.get_sort_stats()["repaired"]
+        check_exact_order(incremental, gaus, moved)
+        assert renderer_ogl.get_sort_stats()["repaired"] == repaired + 1, "the incremental sort did not repair the previous order"
+        full = time_backend(from_scratch, gaus, moved, repeats)
+        repair = time_backend(incremental, gaus, moved, repeats)
+        print(f"incremental after {np.degrees(angle):.2f} deg: full {full * 1000:.1f} ms, repaired {repair * 1000:.1f} ms ({full / repair:.2f}x)")
+
+def main(args):
+    if args.parallel_sizes:
+        bench_parallel(args)
+        return 0
+
+    gaus = random_scene(args.n_gaussians)
+    view_mat = random_view()
+
+    for bits in [16, 32]:
+        max_inversion, step = check_quantized_order(gaus, view_mat, bits)
+        print(f"radix{bits}: max depth inversion {max_inversion:.3e}, quantization step {step:.3e}")
+
+    for name, backend in renderer_ogl._sort_backends.items():
+        print(f"{name}: {time_backend(backend, gaus, view_mat, args.repeats) * 1000:.1f} ms")
+
+    # the smallest camera turn the sort scheduler re-sorts for, and larger ones
+    angles = [np.radians(angle) for angle in args.incremental_angles] or \
+        [util.SortScheduler().angle_threshold, np.radians(2), np.radians(10)]
+    bench_incremental(gaus, view_mat, angles, args.repeats)
+
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    parser.add_argument('--n_gaussians', default=1000000, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    # Compare the parallel sort with the single-threaded one, e.g. --parallel_sizes 100000 1000000 10000000
+    parser.add_argument('--parallel_sizes', nargs='*', default=[], type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    parser.add_argument('--chunks', default=0, type=int)
+    # Camera turns in degrees to time the incremental sort for, the sort scheduler's threshold and larger ones by default
+    parser.add_argument('--incremental_angles', nargs='*', default=[], type=float)
+
+    args, _ = parser.parse_known_args()
+    args = parser.parse_args()
+
+    main(args)
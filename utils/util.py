@@ -139,6 +139,44 @@ class Camera:
         self.is_intrin_dirty = True
 
 
+def view_change(view_a, view_b):
+    # Angle between the viewing directions and distance between the camera positions
+    cos_angle = np.clip(np.dot(view_a[2, :3], view_b[2, :3]), -1, 1)
+    position_a = -view_a[:3, :3].T @ view_a[:3, 3]
+    position_b = -view_b[:3, :3].T @ view_b[:3, 3]
+    return np.arccos(cos_angle), np.linalg.norm(position_a - position_b)
+
+
+class SortScheduler:
+    def __init__(self, angle_threshold=np.radians(0.5), translation_threshold=0.005):
+        self.angle_threshold = angle_threshold
+        self.translation_threshold = translation_threshold
+        self.last_view = None
+        self.last_scene_version = None
+        self.n_sorted = 0
+        self.n_skipped = 0
+
+    def should_sort(self, view_mat, scene_version):
+        # Re-sort only when the scene changed or the view moved past the thresholds
+        view_mat = np.asarray(view_mat)
+        if self.last_view is None or scene_version != self.last_scene_version:
+            dirty = True
+        else:
+            angle, translation = view_change(self.last_view, view_mat)
+            dirty = angle > self.angle_threshold or translation > self.translation_threshold
+
+        if dirty:
+            self.last_view = view_mat
+            self.last_scene_version = scene_version
+            self.n_sorted += 1
+        else:
+            self.n_skipped += 1
+        return dirty
+
+    def invalidate(self):
+        self.last_view = None
+
+
 def load_shaders(vs, fs):
     vertex_shader = open(vs, 'r').read()        
     fragment_shader = open(fs, 'r').read()
@@ -228,6 +266,151 @@ def set_storage_buffer_data(program, key, value: np.ndarray, bind_idx, vao=None,
     glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
     return buffer_id
 
+def has_buffer_storage():
+    # immutable buffer storage is core since GL 4.4 and otherwise comes with ARB_buffer_storage
+    try:
+        return bool(glBufferStorage)
+    except Exception:
+        return False
+
+class StreamingBuffer:
+    # A shader storage buffer the CPU rewrites while the GPU may still be reading it.
+    # With immutable storage it is persistently mapped and split into a ring of slots:
+    # each upload goes to the next slot, once the fence of the last draw that read that
+    # slot has passed. Without it, uploads orphan the old storage with glBufferData.
+    # Slots fit the upload exactly and the buffer is reallocated when it grows, unless
+    # headroom asks for room to grow into (the ring holds n_slots * headroom copies). It is
+    # also reallocated once an upload needs less than the shrink fraction of the slots it
+    # would get, e.g. after the scene arena was compacted
+    n_slots = 3
+
+    def __init__(self, bind_idx, headroom=1.0, shrink=0.5):
+        self.bind_idx = bind_idx
+        self.headroom = headroom
+        self.shrink = shrink
+        self.buffer_id = None
+        self.persistent = has_buffer_storage()
+        self.nbytes = 0
+        self.slot = 0
+        self.slot_size = 0
+        self._mapped = None
+        self._fences = [None] * self.n_slots
+        # byte ranges every slot is missing compared to the newest contents
+        self._stale = [[] for _ in range(self.n_slots)]
+
+    def _allocate(self, nbytes):
+        if self.buffer_id is not None:
+            for slot in range(self.n_slots):
+                self._wait(slot)
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.buffer_id)
+            glUnmapBuffer(GL_SHADER_STORAGE_BUFFER)
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+            glDeleteBuffers(1, [self.buffer_id])
+        self.slot_size = self._fitted_slot_size(nbytes)
+        size = self.slot_size * self.n_slots
+        flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+        self.buffer_id = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.buffer_id)
+        glBufferStorage(GL_SHADER_STORAGE_BUFFER, size, None, flags)
+        pointer = glMapBufferRange(GL_SHADER_STORAGE_BUFFER, 0, size, flags)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+        address = pointer if isinstance(pointer, int) else ctypes.cast(pointer, ctypes.c_void_p).value
+        mapped = np.ctypeslib.as_array((ctypes.c_ubyte * size).from_address(address))
+        self._mapped = [mapped[slot * self.slot_size:(slot + 1) * self.slot_size] for slot in range(self.n_slots)]
+
+    def _fitted_slot_size(self, nbytes):
+        # slots start at multiples of the binding alignment
+        alignment = int(glGetIntegerv(GL_SHADER_STORAGE_BUFFER_OFFSET_ALIGNMENT))
+        return -(-max(int(nbytes * self.headroom), alignment) // alignment) * alignment
+
+    def allocated_nbytes(self):
+        # bytes of GPU storage the buffer holds
+        if self.buffer_id is None:
+            return 0
+        return self.slot_size * self.n_slots if self.persistent else max(self.nbytes, 4)
+
+    def _wait(self, slot):
+        if self._fences[slot] is not None:
+            # the slot is only written once the GPU is done reading it, however long that takes
+            while True:
+                status = glClientWaitSync(self._fences[slot], GL_SYNC_FLUSH_COMMANDS_BIT, 1000000000)
+                if status in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                    break
+                if status == GL_WAIT_FAILED:
+                    glDeleteSync(self._fences[slot])
+                    self._fences[slot] = None
+                    raise RuntimeError("glClientWaitSync failed on a streaming buffer fence")
+            glDeleteSync(self._fences[slot])
+            self._fences[slot] = None
+
+    def _next_slot(self):
+        self.slot = (self.slot + 1) % self.n_slots
+        self._wait(self.slot)
+
+    def _write(self, data, ranges):
+        # write into the next slot, together with what it missed from earlier updates
+        self._next_slot()
+        written = 0
+        for start, end in self._stale[self.slot] + ranges:
+            self._mapped[self.slot][start:end] = data[start:end]
+            written += end - start
+        for slot in range(self.n_slots):
+            self._stale[slot] = [] if slot == self.slot else self._stale[slot] + ranges
+        return written
+
+    def upload(self, value: np.ndarray):
+        data = np.ascontiguousarray(value).reshape(-1).view(np.uint8)
+        self.nbytes = data.nbytes
+        if not self.persistent:
+            if self.buffer_id is None:
+                self.buffer_id = glGenBuffers(1)
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.buffer_id)
+            glBufferData(GL_SHADER_STORAGE_BUFFER, max(data.nbytes, 4), None, GL_STREAM_DRAW)
+            glBufferSubData(GL_SHADER_STORAGE_BUFFER, 0, data.nbytes, data)
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+            self.bind()
+            return data.nbytes
+        if self.buffer_id is None or data.nbytes > self.slot_size or \
+                self._fitted_slot_size(data.nbytes) < self.shrink * self.slot_size:
+            self._allocate(data.nbytes)
+        for slot in range(self.n_slots):
+            self._stale[slot] = []
+        written = self._write(data, [(0, data.nbytes)])
+        self.bind()
+        return written
+
+    def update(self, value: np.ndarray, ranges):
+        # value is the whole newest contents, of which only the given byte ranges changed
+        data = np.ascontiguousarray(value).reshape(-1).view(np.uint8)
+        if self.buffer_id is None or data.nbytes != self.nbytes:
+            return self.upload(value)
+        ranges = [(int(start), int(end)) for start, end in ranges]
+        if not self.persistent:
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.buffer_id)
+            for start, end in ranges:
+                glBufferSubData(GL_SHADER_STORAGE_BUFFER, start, end - start, data[start:end])
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+            return sum(end - start for start, end in ranges)
+        written = self._write(data, ranges)
+        self.bind()
+        return written
+
+    def bind(self):
+        if self.buffer_id is None:
+            return
+        if self.persistent:
+            glBindBufferRange(GL_SHADER_STORAGE_BUFFER, self.bind_idx, self.buffer_id,
+                              self.slot * self.slot_size, max(self.nbytes, 4))
+        else:
+            glBindBufferBase(GL_SHADER_STORAGE_BUFFER, self.bind_idx, self.buffer_id)
+
+    def fence(self):
+        # called after the draws that read the current slot
+        if self.persistent and self.buffer_id is not None:
+            if self._fences[self.slot] is not None:
+                glDeleteSync(self._fences[self.slot])
+            self._fences[self.slot] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
 # called with arguments (vao, self.quad_f) where quad_f = np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32).reshape(2, 3)
 # Very similar strucuture to set_attributes but already exploiting VAO created in set_attributes
 def set_faces_tovao(vao, faces: np.ndarray):
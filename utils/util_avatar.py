@@ -0,0 +1,338 @@
+import numpy as np
+from utils import util_gau
+
+ATTRIBUTES = ("xyz", "rot", "scale", "opacity", "sh")
+
+class AvatarState:
+    # A loaded avatar as a read only base plus per-attribute overrides of the rows edited
+    # since. Whole ranges (animation frames, FLAME poses) are dense blocks that are written
+    # in place, scattered rows (cuts, recolors) are sparse overrides on top of them.
+    # Reading an attribute that has overrides materializes it once, and later edits are
+    # written into that copy as well
+    def __init__(self, base: util_gau.GaussianData):
+        self.base = base
+        for attr in ATTRIBUTES:
+            getattr(base, attr).flags.writeable = False
+        # attribute: [[start, end, values]] sorted by start, not overlapping
+        self._blocks = {}
+        # attribute: (sorted rows, their values)
+        self._overrides = {}
+        self._materialized = {}
+
+    def __len__(self):
+        return len(self.base)
+
+    @property
+    def sh_dim(self):
+        return self.base.sh_dim
+
+    @property
+    def xyz(self):
+        return self._current("xyz")
+
+    @property
+    def rot(self):
+        return self._current("rot")
+
+    @property
+    def scale(self):
+        return self._current("scale")
+
+    @property
+    def opacity(self):
+        return self._current("opacity")
+
+    @property
+    def sh(self):
+        return self._current("sh")
+
+    def _current(self, attr):
+        if attr not in self._blocks and attr not in self._overrides:
+            return getattr(self.base, attr)
+        if attr not in self._materialized:
+            values = self.get(attr)
+            values.flags.writeable = False
+            self._materialized[attr] = values
+        return self._materialized[attr]
+
+    def _write_materialized(self, attr, index, values):
+        if attr in self._materialized:
+            materialized = self._materialized[attr]
+            materialized.flags.writeable = True
+            materialized[index] = values
+            materialized.flags.writeable = False
+
+    def get(self, attr, start=None, end=None):
+        # copy of rows [start, end) of the attribute, edits included
+        start, end, _ = slice(start, end).indices(len(self))
+        base = getattr(self.base, attr)
+        return self.get_into(attr, np.empty((end - start,) + base.shape[1:], dtype=base.dtype), start, end)
+
+    def get_into(self, attr, out, start=None, end=None):
+        # writes rows [start, end) of the attribute, edits included, into out (e.g. the scene
+        # rows of the avatar) without an intermediate copy
+        start, end, _ = slice(start, end).indices(len(self))
+        if attr in self._materialized:
+            out[:] = self._materialized[attr][start:end]
+            return out
+        out[:] = getattr(self.base, attr)[start:end]
+        for block_start, block_end, block in self._blocks.get(attr, []):
+            lo, hi = max(start, block_start), min(end, block_end)
+            if lo < hi:
+                out[lo - start:hi - start] = block[lo - block_start:hi - block_start]
+        if attr in self._overrides:
+            rows, override = self._overrides[attr]
+            lo, hi = np.searchsorted(rows, [start, end])
+            out[rows[lo:hi] - start] = override[lo:hi]
+        return out
+
+    def get_rows(self, attr, rows):
+        rows = np.asarray(rows)
+        values = getattr(self.base, attr)[rows]
+        for block_start, block_end, block in self._blocks.get(attr, []):
+            found = (rows >= block_start) & (rows < block_end)
+            values[found] = block[rows[found] - block_start]
+        if attr in self._overrides and len(rows):
+            override_rows, override = self._overrides[attr]
+            pos = np.minimum(np.searchsorted(override_rows, rows), len(override_rows) - 1)
+            found = override_rows[pos] == rows
+            values[found] = override[pos[found]]
+        return values
+
+    def set(self, attr, index, values, columns=None):
+        # index selects rows as a slice, boolean mask or index array
+        if isinstance(index, slice) and index.step in (None, 1):
+            start, end, _ = index.indices(len(self))
+            if columns is not None:
+                current = self.get(attr, start, end)
+                current[:, columns] = values
+                values = current
+            self._set_block(attr, start, end, values)
+            return
+        rows = np.arange(len(self))[index]
+        if columns is not None:
+            current = self.get_rows(attr, rows)
+            current[:, columns] = values
+            values = current
+        values = np.broadcast_to(np.asarray(values, dtype=np.float32), (len(rows), getattr(self.base, attr).shape[1]))
+        self._write_materialized(attr, rows, values)
+        if attr in self._overrides:
+            old_rows, old_values = self._overrides[attr]
+            keep = ~np.isin(old_rows, rows)
+            rows = np.concatenate([old_rows[keep], rows])
+            values = np.concatenate([old_values[keep], values])
+        order = np.argsort(rows, kind="stable")
+        self._overrides[attr] = (rows[order], np.ascontiguousarray(values[order]))
+
+    def _set_block(self, attr, start, end, values):
+        # rows [start, end) as one dense block, overwritten in place when it is edited again
+        blocks = self._blocks.get(attr, [])
+        same = [block for block in blocks if block[0] == start and block[1] == end]
+        if same:
+            same[0][2][:] = values
+        else:
+            kept = []
+            for block_start, block_end, block in blocks:
+                if block_end <= start or block_start >= end:
+                    kept.append([block_start, block_end, block])
+                    continue
+                # the parts of overlapped blocks outside of the new one stay
+                if block_start < start:
+                    kept.append([block_start, start, np.copy(block[:start - block_start])])
+                if block_end > end:
+                    kept.append([end, block_end, np.copy(block[end - block_start:])])
+            block = np.empty((end - start, getattr(self.base, attr).shape[1]), dtype=np.float32)
+            block[:] = values
+            kept.append([start, end, block])
+            kept.sort(key=lambda block: block[0])
+            self._blocks[attr] = kept
+        self._write_materialized(attr, slice(start, end), values)
+        # the block replaces the sparse rows it covers
+        if attr in self._overrides:
+            rows, override = self._overrides[attr]
+            keep = (rows < start) | (rows >= end)
+            if not np.all(keep):
+                if np.any(keep):
+                    self._overrides[attr] = (rows[keep], override[keep])
+                else:
+                    del self._overrides[attr]
+
+    def update(self, attr, start, values):
+        # overrides the rows from start on that differ from values
+        current = self.get(attr, start, start + len(values))
+        changed = np.flatnonzero(np.any(current != values, axis=1))
+        if len(changed):
+            self.set(attr, start + changed, values[changed])
+
+    def reset(self, attr=None, start=None, end=None):
+        # drops the edits of rows [start, end), of every attribute if none is named
+        start, end, _ = slice(start, end).indices(len(self))
+        for name in [attr] if attr else list(set(self._overrides) | set(self._blocks)):
+            changed = False
+            if name in self._overrides:
+                rows, values = self._overrides[name]
+                keep = (rows < start) | (rows >= end)
+                if not np.all(keep):
+                    changed = True
+                    if np.any(keep):
+                        self._overrides[name] = (rows[keep], values[keep])
+                    else:
+                        del self._overrides[name]
+            if name in self._blocks:
+                kept = []
+                for block_start, block_end, block in self._blocks[name]:
+                    if block_end <= start or block_start >= end:
+                        kept.append([block_start, block_end, block])
+                        continue
+                    changed = True
+                    if block_start < start:
+                        kept.append([block_start, start, np.copy(block[:start - block_start])])
+                    if block_end > end:
+                        kept.append([end, block_end, np.copy(block[end - block_start:])])
+                if kept:
+                    self._blocks[name] = kept
+                else:
+                    del self._blocks[name]
+            if changed:
+                self._materialized.pop(name, None)
+
+    def override_nbytes(self):
+        sparse = sum(rows.nbytes + values.nbytes for rows, values in self._overrides.values())
+        return sparse + sum(block.nbytes for blocks in self._blocks.values() for _, _, block in blocks)
+
+    def get_data(self):
+        return tuple(self.get(attr) for attr in ATTRIBUTES)
+
+    def get_xyz(self, start=None, end=None):
+        return self.get("xyz", start, end)
+
+    def get_rot(self, start=None, end=None):
+        return self.get("rot", start, end)
+
+    def get_scale(self, start=None, end=None):
+        return self.get("scale", start, end)
+
+    def get_opacity(self, start=None, end=None):
+        return self.get("opacity", start, end)
+
+    def get_sh(self, start=None, end=None):
+        return self.get("sh", start, end)
+
+def nbytes(value, seen=None):
+    # bytes of the numpy arrays and torch tensors value holds, through containers and object
+    # attributes. Memory several views share is counted once
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        while isinstance(value.base, np.ndarray):
+            value = value.base
+        if ("array", id(value)) in seen:
+            return 0
+        seen.add(("array", id(value)))
+        return value.nbytes
+    if hasattr(value, "untyped_storage"):
+        storage = value.untyped_storage()
+        if ("storage", storage.data_ptr()) in seen:
+            return 0
+        seen.add(("storage", storage.data_ptr()))
+        return storage.nbytes()
+    if isinstance(value, dict):
+        return sum(nbytes(item, seen) for item in value.values())
+    if isinstance(value, (list, tuple, set)):
+        return sum(nbytes(item, seen) for item in value)
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return 0
+    if hasattr(value, "__slots__"):
+        return sum(nbytes(getattr(value, name, None), seen) for name in value.__slots__)
+    if hasattr(value, "__dict__"):
+        return nbytes(vars(value), seen)
+    return 0
+
+class AvatarRecord:
+    # Editor state of one avatar
+    __slots__ = (
+        "head_avatar", "checkbox", "folder_path", "file_path", "frame_file", "frames", "hairstyle_file", "curls_file",
+        "n_gaussians", "n_strands", "n_gaussians_per_strand", "n_hair_gaussians", "max_distance", "means",
+        "hair_points", "hair_normals", "hair_curls", "hair_amps_freqs",
+        "show_hair", "show_head", "hair_color", "head_color", "show_hair_color", "show_head_color",
+        "hair_scale", "wave_frequency", "wave_amplitude", "frame", "selected_hairstyle",
+        "x_plane", "x_plane_max", "x_plane_min", "invert_x_plane",
+        "y_plane", "y_plane_max", "y_plane_min", "invert_y_plane",
+        "z_plane", "z_plane_max", "z_plane_min", "invert_z_plane",
+        "flame_model", "flame_param", "file_flame_param", "binding", "canonical_flame_hair",
+        "n_flame_vertices", "show_flame_vertices",
+        # first rows of the arena slabs of the avatar and of its FLAME vertices
+        "start", "flame_start",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError(f"Unknown avatar fields: {', '.join(fields)}")
+
+class AvatarColumn:
+    # List-like view of one field of every avatar of a registry
+    __slots__ = ("registry", "name")
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __len__(self):
+        return len(self.registry)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [getattr(record, self.name) for record in self.registry.records[i]]
+        return getattr(self.registry.records[i], self.name)
+
+    def __setitem__(self, i, value):
+        self.registry.set(i, self.name, value)
+
+    def __iter__(self):
+        return (getattr(record, self.name) for record in self.registry.records)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(list(self), dtype=dtype)
+
+class AvatarRegistry:
+    # The loaded avatars in scene order. Each avatar, and its FLAME vertices, has a slab of
+    # its own in the scene arena, so the start rows are stored per avatar
+    def __init__(self):
+        self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def add(self, record):
+        self.records.append(record)
+        return len(self.records) - 1
+
+    def remove(self, i):
+        # the avatars after i move down by one index
+        return self.records.pop(i)
+
+    def set(self, i, name, value):
+        setattr(self.records[i], name, value)
+
+    def start(self, i):
+        # first scene row of avatar i
+        return self.records[i].start
+
+    def flame_start(self, i):
+        # first scene row of the FLAME vertices of avatar i
+        return self.records[i].flame_start
+
+    def column(self, name):
+        if name not in AvatarRecord.__slots__:
+            raise ValueError(f"Unknown avatar field: {name}")
+        return AvatarColumn(self, name)
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from plyfile import PlyData
 from dataclasses import dataclass
@@ -5,6 +6,13 @@ from dataclasses import dataclass
 def slice_data(start, end, data):
         return np.copy(data[0][start:end, :]), np.copy(data[1][start:end, :]), np.copy(data[2][start:end, :]), np.copy(data[3][start:end, :]), np.copy(data[4][start:end, :])
 
+# width in uint32 of the rows of GaussianData.compact_geometry and compact_sh
+COMPACT_GEOMETRY_DIM = 7
+
+def compact_sh_dim(sh_dim):
+    # 3 header words, then 4 of the sh_dim - 3 remaining coefficients per word
+    return 3 + sh_dim // 4 if sh_dim > 3 else 2
+
 @dataclass
 class GaussianData:
     xyz: np.ndarray
@@ -12,9 +20,69 @@ class GaussianData:
     scale: np.ndarray
     opacity: np.ndarray
     sh: np.ndarray
-
-    def flat(self) -> np.ndarray:
-        ret = np.concatenate([self.xyz, self.rot, self.scale, self.opacity, self.sh], axis=-1)
+    # interleaved float32 rows of xyz, rot and scale the first three attributes are views of, if any
+    geometry: np.ndarray = None
+
+    @classmethod
+    def from_buffers(cls, geometry, opacity, sh):
+        return cls(geometry[:, 0:3], geometry[:, 3:7], geometry[:, 7:10], opacity, sh, geometry)
+
+    @classmethod
+    def allocate(cls, n, sh_dim):
+        return cls.from_buffers(np.zeros((n, 10), dtype=np.float32), np.zeros((n, 1), dtype=np.float32), np.zeros((n, sh_dim), dtype=np.float32))
+
+    def rows(self, start, end):
+        # the attributes of rows [start, end) as views into the same memory
+        return GaussianData.from_buffers(self.geometry[start:end], self.opacity[start:end], self.sh[start:end])
+
+    def is_view_of(self, other):
+        # False once an attribute has been replaced by an array of its own
+        return other.geometry is not None and all(np.may_share_memory(a, b) for a, b in [
+            (self.xyz, other.geometry), (self.rot, other.geometry), (self.scale, other.geometry),
+            (self.opacity, other.opacity), (self.sh, other.sh)
+        ])
+
+    def flat_geometry(self, start=None, end=None) -> np.ndarray:
+        if self.geometry is not None and all(np.may_share_memory(a, self.geometry) for a in [self.xyz, self.rot, self.scale]):
+            return self.geometry[start:end]
+        ret = np.concatenate([self.xyz[start:end], self.rot[start:end], self.scale[start:end]], axis=-1)
+        return np.ascontiguousarray(ret, dtype=np.float32)
+
+    def flat_opacity(self, start=None, end=None) -> np.ndarray:
+        return np.ascontiguousarray(self.opacity[start:end], dtype=np.float32)
+
+    def flat_sh(self, start=None, end=None, sh_dim=None) -> np.ndarray:
+        return np.ascontiguousarray(self.sh[start:end, :sh_dim], dtype=np.float32)
+
+    def compact_geometry(self, start=None, end=None) -> np.ndarray:
+        # uint32 rows of COMPACT_GEOMETRY_DIM: float32 xyz, half float rot and half float log scale
+        xyz = np.ascontiguousarray(self.xyz[start:end], dtype=np.float32)
+        halves = np.zeros((len(xyz), 8), dtype=np.float16)
+        halves[:, 0:4] = self.rot[start:end]
+        halves[:, 4:7] = np.log(np.maximum(self.scale[start:end], 1e-30))
+        return np.concatenate([xyz.view(np.uint32), halves.view(np.uint32)], axis=1)
+
+    def compact_sh(self, start=None, end=None, sh_dim=None) -> np.ndarray:
+        # uint32 rows of compact_sh_dim(sh_dim): half float DC color, then the rest of the
+        # coefficients as 8 bit steps between the half float minimum and range of the row
+        sh = self.sh[start:end, :sh_dim]
+        n_rest = sh.shape[1] - 3
+        head = np.zeros((len(sh), 6 if n_rest > 0 else 4), dtype=np.float16)
+        head[:, 0:3] = sh[:, 0:3]
+        if n_rest <= 0:
+            return head.view(np.uint32)
+        rest = sh[:, 3:]
+        head[:, 3] = np.min(rest, axis=1)
+        head[:, 4] = np.max(rest, axis=1) - head[:, 3]
+        # quantized against the rounded minimum and range the shader decodes with
+        low = head[:, 3:4].astype(np.float32)
+        extent = np.maximum(head[:, 4:5].astype(np.float32), 1e-12)
+        steps = np.zeros((len(sh), (n_rest + 3) // 4 * 4), dtype=np.uint8)
+        steps[:, :n_rest] = np.clip(np.rint((rest - low) / extent * 255), 0, 255)
+        return np.concatenate([head.view(np.uint32), steps.view(np.uint32)], axis=1)
+
+    def flat(self, start=None, end=None) -> np.ndarray:
+        ret = np.concatenate([self.xyz[start:end], self.rot[start:end], self.scale[start:end], self.opacity[start:end], self.sh[start:end]], axis=-1)
         return np.ascontiguousarray(ret)
     
     def __len__(self):
@@ -33,6 +101,178 @@ class GaussianData:
     def get_data(self):
         return np.copy(self.xyz), np.copy(self.rot), np.copy(self.scale), np.copy(self.opacity), np.copy(self.sh)
 
+    # copies of single attributes, for edits that need no more than that
+    def get_xyz(self, start=None, end=None):
+        return np.copy(self.xyz[start:end])
+
+    def get_rot(self, start=None, end=None):
+        return np.copy(self.rot[start:end])
+
+    def get_scale(self, start=None, end=None):
+        return np.copy(self.scale[start:end])
+
+    def get_opacity(self, start=None, end=None):
+        return np.copy(self.opacity[start:end])
+
+    def get_sh(self, start=None, end=None):
+        return np.copy(self.sh[start:end])
+
+@dataclass
+class PackedGaussianData(GaussianData):
+    # contiguous interleaved float32 rows (xyz, rot, scale, opacity, sh) all attributes are views of
+    packed: np.ndarray = None
+
+    @classmethod
+    def from_packed(cls, packed):
+        return cls(packed[:, 0:3], packed[:, 3:7], packed[:, 7:10], packed[:, 10:11], packed[:, 11:], packed[:, 0:10], packed)
+
+    @classmethod
+    def pack(cls, gaus):
+        ret = cls.from_packed(np.empty((len(gaus), 11 + gaus.sh_dim), dtype=np.float32))
+        ret.xyz[:], ret.rot[:], ret.scale[:], ret.opacity[:], ret.sh[:] = gaus.xyz, gaus.rot, gaus.scale, gaus.opacity, gaus.sh
+        return ret
+
+    def is_packed(self):
+        # False once an attribute has been replaced by an array of its own
+        return self.packed is not None and all(np.may_share_memory(a, self.packed) for a in [self.xyz, self.rot, self.scale, self.opacity, self.sh])
+
+    def rows(self, start, end):
+        return PackedGaussianData.from_packed(self.packed[start:end])
+
+    def flat_geometry(self, start=None, end=None) -> np.ndarray:
+        # the geometry columns are strided within the packed rows
+        return np.ascontiguousarray(super().flat_geometry(start, end))
+
+    def flat(self, start=None, end=None) -> np.ndarray:
+        if self.is_packed():
+            return self.packed[start:end]
+        return super().flat(start, end)
+
+    def get_data(self):
+        if not self.is_packed():
+            return super().get_data()
+        # one copy of the packed rows rather than one per attribute
+        ret = PackedGaussianData.from_packed(np.copy(self.packed))
+        return ret.xyz, ret.rot, ret.scale, ret.opacity, ret.sh
+
+class GaussianArena:
+    # Scene rows handed out in slabs with spare rows, so that a slab can change its size
+    # without moving the others. Rows no slab uses have zero opacity and are never drawn
+    HEADROOM = 0.25
+    GROWTH = 1.5
+
+    def __init__(self, sh_dim, capacity=0):
+        self.data = GaussianData.allocate(capacity, sh_dim)
+        # start: [used rows, capacity]
+        self.slabs = {}
+        # (start, capacity) of the freed slabs, in row order
+        self.holes = []
+        # first row after the last slab
+        self.end = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def alloc(self, n):
+        # start of a new slab of n used rows
+        for k, (start, capacity) in enumerate(self.holes):
+            if capacity >= n:
+                del self.holes[k]
+                self.slabs[start] = [n, capacity]
+                return start
+        capacity = n + int(n * self.HEADROOM)
+        self._reserve(self.end + capacity)
+        start = self.end
+        self.end += capacity
+        self.slabs[start] = [n, capacity]
+        return start
+
+    def resize(self, start, n):
+        # start of the slab once it has n used rows. It only moves, along with its used rows,
+        # if it has no room left and is not the last slab
+        size, capacity = self.slabs[start]
+        if n > capacity and start + capacity == self.end:
+            capacity = n + int(n * self.HEADROOM)
+            self._reserve(start + capacity)
+            self.end = start + capacity
+        if n <= capacity:
+            self.clear(start + n, start + size)
+            self.slabs[start] = [n, capacity]
+            return start
+        new_start = self.alloc(n)
+        self._copy(self.data, start, new_start, size)
+        self.free(start)
+        return new_start
+
+    def free(self, start):
+        size, capacity = self.slabs.pop(start)
+        self.clear(start, start + size)
+        holes = sorted(self.holes + [(start, capacity)])
+        # neighbouring holes are merged, and a hole at the end gives its rows back
+        self.holes = []
+        for hole_start, hole_capacity in holes:
+            if self.holes and sum(self.holes[-1]) == hole_start:
+                self.holes[-1] = (self.holes[-1][0], self.holes[-1][1] + hole_capacity)
+            else:
+                self.holes.append((hole_start, hole_capacity))
+        if self.holes and sum(self.holes[-1]) == self.end:
+            self.end = self.holes.pop()[0]
+
+    def spare_rows(self):
+        # rows in no slab, which alloc reuses until compact gives them back
+        return len(self.data) - sum(capacity for _, capacity in self.slabs.values())
+
+    def compact(self):
+        # moves the slabs next to each other into storage without spare rows, {old start: new start}
+        moved = {}
+        end = 0
+        for start in sorted(self.slabs):
+            moved[start] = end
+            end += self.slabs[start][1]
+        data = GaussianData.allocate(end, self.data.sh_dim)
+        for start, new_start in moved.items():
+            self._copy(data, start, new_start, self.slabs[start][0])
+        self.slabs = {moved[start]: slab for start, slab in self.slabs.items()}
+        self.holes = []
+        self.end = end
+        self.data = data
+        return moved
+
+    def nbytes(self):
+        return self.data.geometry.nbytes + self.data.opacity.nbytes + self.data.sh.nbytes
+
+    def clear(self, start, end):
+        self.data.geometry[start:end] = 0
+        self.data.opacity[start:end] = 0
+        self.data.sh[start:end] = 0
+
+    def rows(self, start):
+        # used rows of the slab, as views into the arena
+        return self.data.rows(start, start + self.slabs[start][0])
+
+    def write(self, start, gaus, offset=0):
+        # fills rows offset on of the slab, rows with fewer SH coefficients are zero padded
+        view = self.rows(start).rows(offset, offset + len(gaus))
+        view.xyz[:], view.rot[:], view.scale[:], view.opacity[:] = gaus.xyz, gaus.rot, gaus.scale, gaus.opacity
+        view.sh[:, :gaus.sh.shape[1]] = gaus.sh
+        view.sh[:, gaus.sh.shape[1]:] = 0
+
+    def capacity(self, start):
+        return self.slabs[start][1]
+
+    def _reserve(self, n):
+        # reallocating copies the scene, so capacity grows geometrically
+        if n <= len(self.data):
+            return
+        data = GaussianData.allocate(max(n, int(len(self.data) * self.GROWTH)), self.data.sh_dim)
+        self._copy(data, 0, 0, self.end)
+        self.data = data
+
+    def _copy(self, data, src, dst, n):
+        # rows [src, src + n) of the arena to rows [dst, dst + n) of data
+        for attr in ["geometry", "opacity", "sh"]:
+            getattr(data, attr)[dst:dst + n] = getattr(self.data, attr)[src:src + n]
+
 def naive_gaussian():
     gau_xyz = np.array([
         0, 0, 0,
@@ -93,7 +333,90 @@ def random_gaussian(gaussians):
 
     return GaussianData(xyz, rots, scales, opacities, rgb)
 
+# numpy types of the PLY scalar property types
+PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+
+def read_ply_vertices(path):
+    # Structured memmap of the vertex rows of a binary little endian PLY whose first element
+    # are the vertices, with scalar properties only. None for any other file
+    with open(path, "rb") as f:
+        if f.readline().strip() != b"ply":
+            return None
+        fmt, elements = None, []
+        while True:
+            line = f.readline()
+            if not line:
+                return None
+            words = line.decode("ascii", "replace").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "end_header":
+                break
+            if words[0] == "format":
+                fmt = words[1]
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property" and elements:
+                if words[1] == "list" or words[1] not in PLY_TYPES:
+                    return None
+                elements[-1][2].append((words[2], "<" + PLY_TYPES[words[1]]))
+        offset = f.tell()
+    if fmt != "binary_little_endian" or not elements or elements[0][0] != "vertex":
+        return None
+    _, count, properties = elements[0]
+    dtype = np.dtype(properties)
+    if os.path.getsize(path) < offset + count * dtype.itemsize:
+        return None
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
 def load_ply(path):
+    # Gathers the float32 vertex properties of binary PLY files straight into the packed
+    # rows, with the same output as load_ply_plyfile
+    max_sh_degree = 3
+
+    vertices = read_ply_vertices(path)
+    names = vertices.dtype.names if vertices is not None else ()
+    scale_names = sorted([name for name in names if name.startswith("scale_")], key = lambda x: int(x.split('_')[-1]))
+    rot_names = sorted([name for name in names if name.startswith("rot")], key = lambda x: int(x.split('_')[-1]))
+    extra_f_names = sorted([name for name in names if name.startswith("f_rest_")], key = lambda x: int(x.split('_')[-1]))
+    n_coeffs = (max_sh_degree + 1) ** 2 - 1
+    if len(extra_f_names) != 3 * n_coeffs or len(rot_names) != 4 or len(scale_names) != 3:
+        return load_ply_plyfile(path)
+    # f_rest_* are stored per color channel, the SH rows interleave the channels per coefficient
+    extra_f_names = [extra_f_names[c * n_coeffs + k] for k in range(n_coeffs) for c in range(3)]
+    fields = ["x", "y", "z"] + rot_names + scale_names + ["opacity", "f_dc_0", "f_dc_1", "f_dc_2"] + extra_f_names
+    if any(vertices.dtype.fields[name][0] != np.dtype("<f4") for name in fields):
+        return load_ply_plyfile(path)
+
+    columns = [vertices.dtype.fields[name][1] // 4 for name in fields]
+    if vertices.dtype.itemsize % 4 == 0 and all(vertices.dtype.fields[name][1] % 4 == 0 for name in fields):
+        # the rows as float32 words, gathered into the packed column order in one pass
+        words = vertices.view(np.float32).reshape(len(vertices), -1)
+        packed = np.take(words, columns, axis=1)
+    else:
+        packed = np.empty((len(vertices), len(fields)), dtype=np.float32)
+        for k, name in enumerate(fields):
+            packed[:, k] = vertices[name]
+    gaus = PackedGaussianData.from_packed(packed)
+    rots = gaus.rot.astype(np.float64)
+    gaus.rot[:] = rots / np.linalg.norm(rots, axis=-1, keepdims=True)
+    gaus.scale[:] = np.exp(gaus.scale.astype(np.float64))
+    gaus.opacity[:] = 1 / (1 + np.exp(-np.asarray(vertices["opacity"])[..., np.newaxis]))
+
+    if "n_strands" in names:
+        head_avatar_constants = (vertices["n_strands"][0], vertices["n_gaussians_per_strand"][0])
+    else:
+        head_avatar_constants = (0, 0)
+    del vertices
+
+    return gaus, head_avatar_constants
+
+def load_ply_plyfile(path):
     max_sh_degree = 3
 
     plydata = PlyData.read(path)
@@ -157,7 +480,7 @@ def load_ply(path):
     else:
         head_avatar_constants = (0, 0)
     
-    return GaussianData(xyz, rots, scales, opacities, shs), head_avatar_constants
+    return PackedGaussianData.pack(GaussianData(xyz, rots, scales, opacities, shs)), head_avatar_constants
 
 def load_input_ply(path):
     plydata = PlyData.read(path)